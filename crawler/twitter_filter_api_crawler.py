@@ -1,7 +1,9 @@
 import logging
+import queue
+import threading
 import time
 import traceback
-from typing import List
+from typing import List, Optional, Callable, Iterator, Dict
 
 import rootpath
 
@@ -9,6 +11,8 @@ rootpath.append()
 
 from crawler.crawlerbase import CrawlerBase
 from utilities.cacheset import CacheSet
+from utilities.id_filter import SharedIdFilter
+from utilities.keyword_matcher import KeywordMatcher
 from utilities.twitter_api_load_balancer import TwitterAPILoadBalancer
 
 logger = logging.getLogger()
@@ -16,15 +20,22 @@ logger = logging.getLogger()
 
 class TweetFilterAPICrawler(CrawlerBase):
     MAX_WAIT_TIME = 64
+    # put by the stream reader thread once the stream ends without an error
+    _STREAM_END = object()
 
-    def __init__(self):
+    def __init__(self, id_filter: Optional[SharedIdFilter] = None):
         super().__init__()
         self.wait_time = 1
         self.api = TwitterAPILoadBalancer().get()
         self.data: List = []
         self.keywords = []
+        # compiled from self.keywords, rebuilt only when crawl is given a different keyword set
+        self.matcher = KeywordMatcher(())
         self.total_crawled_count = 0
         self.cache: CacheSet[int] = CacheSet()
+        # shared with the other crawler processes of this host, only checked here, the caller marks the ids it stores.
+        # if not given ids are deduplicated in this process only
+        self.id_filter = id_filter
 
     def crawl(self, keywords: List, batch_number: int = 100) -> List[int]:
         """
@@ -45,7 +56,7 @@ class TweetFilterAPICrawler(CrawlerBase):
              (List[int]): a list of Tweet IDs
 
         """
-        self.keywords = list(map(str.lower, keywords + ["#" + keyword for keyword in keywords]))
+        self._set_keywords(keywords)
         logger.info(f'Filter Mode crawler Started')
         self.data = []
         count = 0
@@ -55,18 +66,7 @@ class TweetFilterAPICrawler(CrawlerBase):
 
                 for tweet in self.api.GetStreamFilter(track=self.keywords):
                     self.reset_wait_time()
-                    if tweet.get('text') is None:
-                        continue
-
-                    # if the original tweet has keywords, add its id to cache and data
-                    if tweet.get('retweeted_status') and self._has_keywords(tweet['retweeted_status']):
-                        self._add_to_batch(tweet['retweeted_status']['id'])
-
-                    # if the tweet contains keywords, add its id to cache and data (for return)
-                    elif self._has_keywords(tweet):
-                        self._add_to_batch(tweet['id'])
-                    else:
-                        continue
+                    self._collect(tweet)
 
                     # print Crawling info every one tenth of the batch number
                     if len(self.data) > count:
@@ -90,16 +90,134 @@ class TweetFilterAPICrawler(CrawlerBase):
         logger.info(f'Total crawled count {self.total_crawled_count}')
         return self.data
 
+    def stream(self, read_keywords: Callable[[], List[str]], batch_number: int = 100, batch_interval: float = 10,
+               check_interval: float = 30) -> Iterator[List[int]]:
+        """
+        Crawling Tweet ID batches from one long-lived Twitter Filter API connection.
+
+        Unlike crawl, the connection stays open between batches. It is only reopened when the keywords returned by
+        read_keywords change (checked every check_interval seconds) or when the stream drops, with the same back-off
+        as crawl.
+
+        Args:
+
+            read_keywords (Callable[[], List[str]]): returns the current keywords, e.g. from keywords.txt.
+
+            batch_number (int): a batch is yielded once it has this many IDs.
+
+            batch_interval (float): or once its first ID is this many seconds old, whether or not tweets arrive.
+
+            check_interval (float): seconds between two calls of read_keywords.
+
+        Returns:
+             (Iterator[List[int]]): batches of Tweet IDs
+
+        """
+        self._set_keywords(read_keywords())
+        self.data = []
+        # when the first id of the current batch came in, None while the batch is empty
+        batch_started = None
+        checked_at = time.monotonic()
+        while True:
+            logger.info(f'Filter Mode opening a stream to Twitter Filter API')
+            tweets, stop = queue.Queue(), threading.Event()
+            stream = self.api.GetStreamFilter(track=self.keywords)
+            threading.Thread(target=self._read_stream, args=(stream, tweets, stop), name='filter-stream',
+                             daemon=True).start()
+            try:
+                while True:
+                    # wakes up for the batch age and the keyword check even when no tweet arrives
+                    deadline = checked_at + check_interval
+                    if batch_started is not None:
+                        deadline = min(deadline, batch_started + batch_interval)
+                    try:
+                        tweet = tweets.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        tweet = None
+                    if tweet is self._STREAM_END:
+                        logger.warning(f'Filter Mode stream ended, reconnecting')
+                        self.wait()
+                        break
+                    if isinstance(tweet, Exception):
+                        error = ''.join(traceback.format_exception(type(tweet), tweet, tweet.__traceback__))
+                        logger.error(f'Error: {error}')
+                        self.wait()
+                        break
+                    if tweet is not None:
+                        self.reset_wait_time()
+                        was_empty = not self.data
+                        self._collect(tweet)
+                        if was_empty and self.data:
+                            batch_started = time.monotonic()
+                    if self.data and (len(self.data) >= batch_number or
+                                      time.monotonic() - batch_started >= batch_interval):
+                        batch, self.data, batch_started = self.data, [], None
+                        self.total_crawled_count += len(batch)
+                        logger.info(f'Outputting {len(batch)} Tweet IDs, '
+                                    f'total crawled count {self.total_crawled_count}')
+                        yield batch
+                    if time.monotonic() - checked_at >= check_interval:
+                        checked_at = time.monotonic()
+                        if self._set_keywords(read_keywords()):
+                            logger.info(f'Filter Mode keywords changed, reconnecting')
+                            break
+            finally:
+                stop.set()
+
+    @classmethod
+    def _read_stream(cls, stream: Iterator[Dict], tweets: queue.Queue, stop: threading.Event) -> None:
+        """
+        puts the tweets of the stream into the queue, then _STREAM_END or the exception that ended it.
+
+        python-twitter swallows the keep-alive lines, so a stopped reader only notices on its next tweet. Twitter drops
+        the older connection of a credential once a new one opens, which ends it anyway.
+        """
+        try:
+            for tweet in stream:
+                if stop.is_set():
+                    return
+                tweets.put(tweet)
+            tweets.put(cls._STREAM_END)
+        except Exception as err:
+            if not stop.is_set():
+                tweets.put(err)
+        finally:
+            stream.close()
+
+    def _collect(self, tweet: Dict) -> None:
+        """adds the id of the tweet, or of its original tweet, to the batch if it has keywords"""
+        if tweet.get('text') is None:
+            return
+
+        # if the original tweet has keywords, add its id to cache and data
+        if tweet.get('retweeted_status') and self._has_keywords(tweet['retweeted_status']):
+            self._add_to_batch(tweet['retweeted_status']['id'])
+
+        # if the tweet contains keywords, add its id to cache and data (for return)
+        elif self._has_keywords(tweet):
+            self._add_to_batch(tweet['id'])
+
+    def _set_keywords(self, keywords: List[str]) -> bool:
+        """compiles the keywords and their hash-tags, returns whether they differ from the current ones"""
+        keywords = list(map(str.lower, keywords + ["#" + keyword for keyword in keywords]))
+        if set(keywords) == self.matcher.keywords:
+            return False
+        self.keywords = keywords
+        self.matcher = KeywordMatcher(keywords)
+        logger.info(f'Filter Mode compiled {self.matcher}')
+        return True
+
     def _has_keywords(self, tweet):
         try:
-            return any([keyword in tweet['text'].lower() for keyword in set(self.keywords)])
+            return self.matcher.search(tweet['text'].lower())
         except:
             print(tweet)
 
     def _add_to_batch(self, tweet_id: int) -> None:
         if tweet_id not in self.cache:
-            self.data.append(tweet_id)
             self.cache.add(tweet_id)
+            if self.id_filter is None or tweet_id not in self.id_filter:
+                self.data.append(tweet_id)
 
     def reset_wait_time(self) -> None:
         """resets the wait time"""
@@ -2,7 +2,9 @@ import json
 import logging
 import time
 import traceback
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterable, Iterator, Tuple
 
 import rootpath
 import twitter
@@ -11,7 +13,7 @@ rootpath.append()
 
 from crawler.crawlerbase import CrawlerBase
 from crawler.twitter_filter_api_crawler import TweetFilterAPICrawler
-
+from paths import TWITTER_API_CONFIG_PATH
 from utilities.twitter_api_load_balancer import TwitterAPILoadBalancer
 
 logger = logging.getLogger()
@@ -19,6 +21,8 @@ logger = logging.getLogger()
 
 class TweetIDModeCrawler(CrawlerBase):
     MAX_WAIT_TIME = 64
+    # rate limit resource of GetStatuses
+    ENDPOINT = '/statuses/lookup'
 
     def __init__(self):
         super().__init__()
@@ -42,16 +46,7 @@ class TweetIDModeCrawler(CrawlerBase):
         unique_ids = list(set(ids))
         while True:
             try:
-                logger.info(f'ID Mode sending a Request to Twitter Get Status API')
-                status = self.api.GetStatuses(unique_ids)
-                self.data = set()
-                for i, tweet_json_string in enumerate(status):
-                    tweet = json.loads(str(tweet_json_string))
-                    if tweet.get('retweeted_status'):
-                        self.data.add(json.dumps(tweet.get('retweeted_status')))
-                    else:
-                        self.data.add(tweet_json_string)
-                self.data = list(self.data)
+                self.data = self._get_statuses(self.api, unique_ids)
                 self.reset_wait_time()
             except:
                 logger.error('error: ' + traceback.format_exc())
@@ -70,6 +65,73 @@ class TweetIDModeCrawler(CrawlerBase):
         # also return a reference of self.data
         return self.data
 
+    @staticmethod
+    def _get_statuses(api: twitter.Api, unique_ids: List[int]) -> List:
+        """sends one GetStatuses request, returns the tweets, or the original tweets of the retweets"""
+        logger.info(f'ID Mode sending a Request to Twitter Get Status API')
+        status = api.GetStatuses(unique_ids)
+        data = set()
+        for i, tweet_json_string in enumerate(status):
+            tweet = json.loads(str(tweet_json_string))
+            if tweet.get('retweeted_status'):
+                data.add(json.dumps(tweet.get('retweeted_status')))
+            else:
+                data.add(tweet_json_string)
+        return list(data)
+
+    def _hydrate(self, ids: List[int]) -> List:
+        """crawls one batch with the free credential that has the most budget, retrying with back-off like crawl"""
+        unique_ids = list(set(ids))
+        wait_time = 1
+        while True:
+            api = TwitterAPILoadBalancer.acquire(self.ENDPOINT, exclusive=True)
+            try:
+                return self._get_statuses(api, unique_ids)
+            except:
+                logger.error('error: ' + traceback.format_exc())
+            finally:
+                TwitterAPILoadBalancer.release(api, self.ENDPOINT)
+            time.sleep(wait_time)
+            wait_time = min(wait_time * 2, self.MAX_WAIT_TIME)
+
+    def crawl_many(self, id_batches: Iterable[List[int]]) -> Iterator[Tuple[List[int], List]]:
+        """
+        Crawling twitter.Status for a stream of Tweet Id lists, with all the configured credentials at once.
+
+        Each credential has at most one GetStatuses request in flight, the batches are pulled from id_batches as
+        credentials free up, going to the one with the most rate limit budget left, and the results come back in the
+        order of the batches. Once all credentials are out of budget the workers wait for the earliest reset.
+
+        Args:
+            id_batches (Iterable[List[int]]): lists of up to 100 Tweet IDs, e.g. from a database cursor.
+
+        Returns:
+            Iterator[Tuple[List[int], List[twitter.Status]]]: each id list with its crawled statuses.
+
+        """
+        worker_count = len(TwitterAPILoadBalancer.get_apis())
+        if not worker_count:
+            raise ValueError(f"no twitter credentials configured in {TWITTER_API_CONFIG_PATH}")
+        logger.info(f'ID Mode crawler Started with {worker_count} credentials')
+        with ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix='id-mode') as executor:
+            pending = deque()
+            for ids in id_batches:
+                # copied, the caller may reuse its list while this batch is still queued
+                ids = list(ids)
+                pending.append((ids, executor.submit(self._hydrate, ids)))
+                # the next batches are already queued while the caller handles the oldest one
+                if len(pending) >= 2 * worker_count:
+                    yield self._collect(*pending.popleft())
+            while pending:
+                yield self._collect(*pending.popleft())
+
+    def _collect(self, ids: List[int], future) -> Tuple[List[int], List]:
+        self.data = future.result()
+        self.total_crawled_count += len(self.data)
+        logger.info(f'ID Mode returning twitter.Status count: {len(self.data)}, '
+                    f'total crawled count {self.total_crawled_count}')
+        return ids, self.data
+
     def reset_wait_time(self):
         """resets the wait time"""
         self.wait_time = 1
@@ -4,7 +4,7 @@ import string
 import time
 import traceback
 import urllib
-from typing import List, Set
+from typing import List, Set, Optional
 
 import requests
 import rootpath
@@ -14,6 +14,7 @@ rootpath.append()
 
 from crawler.crawlerbase import CrawlerBase
 from utilities.cacheset import CacheSet
+from utilities.id_filter import SharedIdFilter
 
 from utilities.twitter_api_load_balancer import TwitterAPILoadBalancer
 logger = logging.getLogger()
@@ -22,7 +23,7 @@ logger = logging.getLogger()
 class TweetSearchAPICrawler(CrawlerBase):
     MAX_WAIT_TIME = 64
 
-    def __init__(self):
+    def __init__(self, id_filter: Optional[SharedIdFilter] = None):
         super().__init__()
         self.wait_time = 1
         self.api = TwitterAPILoadBalancer().get()
@@ -30,6 +31,9 @@ class TweetSearchAPICrawler(CrawlerBase):
         self.keywords = []
         self.total_crawled_count = 0
         self.cache: CacheSet[int] = CacheSet()
+        # shared with the other crawler processes of this host, only checked here, the caller marks the ids it stores.
+        # if not given ids are deduplicated in this process only
+        self.id_filter = id_filter
         self.data_from_db_count = 0
         self.ua = UserAgent()
 
@@ -100,9 +104,11 @@ class TweetSearchAPICrawler(CrawlerBase):
         return self._filter(ids)
 
     def _filter(self, ids: Set[int]) -> List[int]:
-        """using self.cache to filter out duplicates"""
+        """using self.cache, then self.id_filter if given, to filter out duplicates"""
         unique_ids = list(filter(lambda i: i not in self.cache, ids))
         self.cache.update(unique_ids)
+        if self.id_filter is not None:
+            unique_ids = self.id_filter.unseen(unique_ids)
         return unique_ids
 
 
@@ -0,0 +1,254 @@
+import logging
+import os
+import pickle
+import threading
+import time
+import traceback
+from collections import deque
+from typing import List, Dict, Union, Optional
+
+import rootpath
+
+rootpath.append()
+
+from paths import DUMPER_SPILL_DIR
+
+from dumper.dumperbase import DumperBase
+from dumper.twitter_dumper import TweetDumper
+
+logger = logging.getLogger()
+
+
+class BufferedDumper(DumperBase):
+    """
+    Write-behind wrapper of a TweetDumper, insert only queues the records and returns.
+
+    A background thread flushes the queue through the wrapped dumper once flush_size records are queued or the oldest
+    queued record is max_age seconds old. When max_pending records are queued, insert either blocks until the thread
+    catches up ('block') or pickles the batch under spill_dir ('spill'), spilled batches are flushed once the queue
+    is empty again, including the ones left by a previous process. A batch is claimed by renaming it before it is
+    replayed, so processes sharing spill_dir never replay the same one, and handed back if its insert fails. With
+    'spill', a queued batch whose insert fails is spilled to be retried as well, with 'block' it is dropped and counted
+    in failed_count. close() drains everything before returning.
+    """
+    OVERFLOW_POLICIES = ('block', 'spill')
+
+    def __init__(self, dumper: Optional[TweetDumper] = None, flush_size: int = 1000, max_age: float = 5.0,
+                 max_pending: int = 10000, overflow: str = 'block', spill_dir: str = DUMPER_SPILL_DIR):
+        super().__init__()
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {overflow}, expecting one of {self.OVERFLOW_POLICIES}")
+        self.dumper = dumper if dumper is not None else TweetDumper()
+        self.flush_size = flush_size
+        self.max_age = max_age
+        self.max_pending = max(max_pending, flush_size)
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        if overflow == 'spill':
+            os.makedirs(spill_dir, exist_ok=True)
+        self.spilled_count = 0
+        self.flushed_count = 0
+        self.failed_count = 0
+
+        # (enqueue time, id_mode, records) in insertion order
+        self._pending = deque()
+        self._pending_count = 0
+        self._flushing = False
+        self._flush_requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def insert(self, data_list: List[Union[Dict, int]], id_mode=False) -> None:
+        """queues the given list for the background thread, see TweetDumper.insert"""
+        if not data_list:
+            return
+        data_list = list(data_list)
+        with self._condition:
+            if self._closed:
+                raise ValueError(f"{self.__class__.__name__} is closed")
+            if self._pending_count + len(data_list) > self.max_pending:
+                if self.overflow == 'spill':
+                    self._spill(data_list, id_mode)
+                    return
+                # backpressure, a batch larger than max_pending waits for an empty queue only
+                logger.warning(f"dumper queue full with {self._pending_count} records, waiting for a flush")
+                self._condition.wait_for(lambda: self._closed or self._pending_count == 0
+                                         or self._pending_count + len(data_list) <= self.max_pending)
+                if self._closed:
+                    raise ValueError(f"{self.__class__.__name__} was closed while waiting for a flush")
+            self._pending.append((time.monotonic(), id_mode, data_list))
+            self._pending_count += len(data_list)
+            if self._pending_count >= self.flush_size:
+                self._condition.notify_all()
+
+    def _spill(self, data_list: List[Union[Dict, int]], id_mode: bool) -> None:
+        path = os.path.join(self.spill_dir, f'{time.time_ns()}-{os.getpid()}.pickle')
+        with open(path + '.tmp', 'wb') as spill_file:
+            pickle.dump((id_mode, data_list), spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        self.spilled_count += len(data_list)
+        logger.warning(f"dumper queue full, spilled {len(data_list)} records to {path}")
+
+    def _spilled_paths(self) -> List[str]:
+        """returns the spilled batches to replay, the unclaimed ones and the ones claimed by a dead process"""
+        if not os.path.isdir(self.spill_dir):
+            return []
+        paths = []
+        for name in os.listdir(self.spill_dir):
+            if name.endswith('.pickle'):
+                paths.append(os.path.join(self.spill_dir, name))
+            elif name.endswith('.claimed'):
+                # <batch>.pickle.<pid>.claimed
+                pickle_name, _, pid = name[:-len('.claimed')].rpartition('.')
+                if pid.isdigit() and not self._alive(int(pid)):
+                    paths.append(os.path.join(self.spill_dir, name))
+        return sorted(paths)
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _claim(self, path: str) -> Optional[str]:
+        """renames a spilled batch so that no other process replays it, returns None if one claimed it first"""
+        batch_path = path[:path.index('.pickle') + len('.pickle')]
+        claimed_path = f'{batch_path}.{os.getpid()}.claimed'
+        try:
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            return None
+        return claimed_path
+
+    def _due(self) -> bool:
+        if self._closed or self._flush_requested or self._pending_count >= self.flush_size:
+            return True
+        return bool(self._pending) and time.monotonic() - self._pending[0][0] >= self.max_age
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(self._due, timeout=self.max_age)
+                if not self._pending and self._closed:
+                    break
+                batches = []
+                if self._due():
+                    batches = list(self._pending)
+                    self._pending.clear()
+                    self._pending_count = 0
+                    self._flush_requested = False
+                self._flushing = True
+                # producers blocked on a full queue can go on while this batch is written
+                self._condition.notify_all()
+            try:
+                self._flush(batches)
+                if not batches:
+                    self._flush_spilled()
+            except Exception as err:
+                # the thread has to outlive any failure, producers are waiting on it
+                logger.error(str(err) + traceback.format_exc())
+            finally:
+                with self._condition:
+                    self._flushing = False
+                    self._condition.notify_all()
+        try:
+            self._flush_spilled()
+        except Exception as err:
+            logger.error(str(err) + traceback.format_exc())
+
+    def _flush(self, batches) -> None:
+        # consecutive batches of the same mode go out in one insert
+        records, mode = [], None
+        for _, id_mode, data_list in batches:
+            if records and id_mode != mode:
+                self._insert_or_keep(records, mode)
+                records = []
+            records.extend(data_list)
+            mode = id_mode
+        if records:
+            self._insert_or_keep(records, mode)
+
+    def _insert_or_keep(self, records: List[Union[Dict, int]], id_mode: bool) -> None:
+        if self._insert(records, id_mode):
+            return
+        if self.overflow == 'spill':
+            self._spill(records, id_mode)
+        else:
+            self.failed_count += len(records)
+
+    def _flush_spilled(self) -> None:
+        for path in self._spilled_paths():
+            path = self._claim(path)
+            if path is None:
+                continue
+            try:
+                with open(path, 'rb') as spill_file:
+                    id_mode, data_list = pickle.load(spill_file)
+            except (OSError, pickle.UnpicklingError, EOFError) as err:
+                logger.error(f"can not load spilled batch {path}: {err}")
+                # set aside, a broken batch is not retried
+                try:
+                    os.replace(path, f'{path}.broken')
+                except OSError:
+                    pass
+                continue
+            if not self._insert(data_list, id_mode):
+                # handed back for a later round, the rest of the spill waits as well
+                os.replace(path, path[:path.index('.pickle') + len('.pickle')])
+                return
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            with self._condition:
+                # new records go first, the rest of the spill waits for the next idle round
+                if self._pending and not self._closed:
+                    return
+
+    def _insert(self, records: List[Union[Dict, int]], id_mode: bool) -> bool:
+        """inserts the records through the wrapped dumper, returns whether it succeeded"""
+        try:
+            # TweetDumper.insert logs its database errors and returns False instead of raising
+            if self.dumper.insert(records, id_mode=id_mode) is False:
+                return False
+        except Exception as err:
+            logger.error(str(err) + traceback.format_exc())
+            return False
+        self.flushed_count += len(records)
+        return True
+
+    def flush(self) -> None:
+        """blocks until the records queued so far are written"""
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: not self._pending and not self._flushing)
+
+    def close(self) -> None:
+        """stops accepting records and blocks until the queue and the spilled batches are written"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        logger.info(f"{self} drained")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def report_status(self):
+        return self.dumper.report_status()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}{{pending={self._pending_count}, flushed={self.flushed_count}, ' \
+               f'spilled={self.spilled_count}, failed={self.failed_count}, dumper={self.dumper}}}'
+
+    __repr__ = __str__
@@ -0,0 +1,74 @@
+import datetime
+import io
+import struct
+from typing import Iterable, Sequence, Tuple, Any
+
+# postgres counts timestamps in microseconds from this epoch
+PG_EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+BINARY_TRAILER = struct.pack('>h', -1)
+_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _to_text(value: Any) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if hasattr(value, 'to_ewkb'):
+        # postgis geometries, geometry_in takes hex EWKB
+        return value.to_ewkb()
+    return str(value).translate(_TEXT_ESCAPES)
+
+
+def text_copy(rows: Iterable[Sequence[Any]]) -> io.BytesIO:
+    """returns the rows encoded for COPY ... FROM STDIN in the default text format"""
+    buffer = io.BytesIO()
+    for row in rows:
+        buffer.write(('\t'.join(map(_to_text, row)) + '\n').encode('utf-8'))
+    buffer.seek(0)
+    return buffer
+
+
+def _bigint(value: int) -> bytes:
+    return struct.pack('>q', value)
+
+
+def _timestamptz(value: datetime.datetime) -> bytes:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    delta = value - PG_EPOCH
+    return struct.pack('>q', (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def _text(value: Any) -> bytes:
+    return str(value).encode('utf-8')
+
+
+def _geometry(value: Any) -> bytes:
+    # geometry_recv takes EWKB bytes
+    return bytes.fromhex(value.to_ewkb())
+
+
+BINARY_ENCODERS = {'bigint': _bigint, 'timestamptz': _timestamptz, 'text': _text, 'geometry': _geometry}
+
+
+def binary_copy(rows: Iterable[Sequence[Any]], column_types: Tuple[str, ...]) -> io.BytesIO:
+    """returns the rows encoded for COPY ... FROM STDIN (FORMAT binary), column_types are keys of BINARY_ENCODERS
+    and have to match the types of the target table columns exactly"""
+    encoders = [BINARY_ENCODERS[column_type] for column_type in column_types]
+    field_count = struct.pack('>h', len(encoders))
+    buffer = io.BytesIO()
+    buffer.write(BINARY_HEADER)
+    for row in rows:
+        buffer.write(field_count)
+        for encode, value in zip(encoders, row):
+            if value is None:
+                buffer.write(struct.pack('>i', -1))
+            else:
+                field = encode(value)
+                buffer.write(struct.pack('>i', len(field)))
+                buffer.write(field)
+    buffer.write(BINARY_TRAILER)
+    buffer.seek(0)
+    return buffer
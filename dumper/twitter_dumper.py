@@ -1,15 +1,20 @@
 import datetime
 import logging
 import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple, Union, Iterable
 
+import numpy as np
 import rootpath
+from postgis import Point
 from psycopg2 import extras
 
 rootpath.append()
 
 from utilities.connection import Connection
 
+from dumper.copy_format import binary_copy, text_copy
 from dumper.dumperbase import DumperBase
 
 logger = logging.getLogger()
@@ -38,12 +43,76 @@ screen_name = excluded.screen_name, user_name = excluded.user_name, followers_co
 favourites_count = excluded.favourites_count, friends_count= excluded.friends_count, user_id= excluded.user_id, 
 user_location= excluded.user_location, statuses_count= excluded.statuses_count;"""
 
+    # skip_unchanged mode, a conflicting row is only rewritten when one of its columns changed, so re-hydrated rows
+    # that are identical cost no dead tuple and no WAL. RETURNING tells the inserted rows from the updated ones,
+    # the rows missing from the result were unchanged
+    UPDATE_COLUMNS = ('create_at', 'text', 'hash_tag', 'profile_pic', 'created_date_time', 'screen_name', 'user_name',
+                      'followers_count', 'favourites_count', 'friends_count', 'user_id', 'user_location',
+                      'statuses_count')
+    CHANGED_CONDITION = f"""
+WHERE ({', '.join('records.' + column for column in UPDATE_COLUMNS)}) 
+IS DISTINCT FROM ({', '.join('excluded.' + column for column in UPDATE_COLUMNS)})"""
+    CHANGED_WITH_LOCATION_CONDITION = f"""
+WHERE ({', '.join('records.' + column for column in UPDATE_COLUMNS + ('location',))}) 
+IS DISTINCT FROM ({', '.join('excluded.' + column for column in UPDATE_COLUMNS + ('location',))})"""
+
+    SKIP_UNCHANGED_INSERT_WITH_LOCATION_QUERY = \
+        INSERT_WITH_LOCATION_QUERY.rstrip(';') + CHANGED_WITH_LOCATION_CONDITION + "\nRETURNING xmax = 0;"
+    SKIP_UNCHANGED_INSERT_WITHOUT_LOCATION_QUERY = \
+        INSERT_WITHOUT_LOCATION_QUERY.rstrip(';') + CHANGED_CONDITION + "\nRETURNING xmax = 0;"
+
     INSERT_LOCATION_QUERY = "INSERT INTO records (id) VALUES %s ON CONFLICT(id) DO NOTHING"
 
-    def __init__(self):
+    DELETE_QUERY = "UPDATE records SET deleted = true WHERE id = ANY(%s::bigint[])"
+    DELETE_CHUNK_SIZE = 10000
+
+    # parallel mode, records are split by the creation day of the tweet or by a hash of its id
+    PARTITION_KEYS = ('day', 'id')
+
+    # bulk mode, records are COPY'd into a staging table and merged into records with a single upsert
+    STAGING_COLUMNS = (('id', 'bigint'), ('create_at', 'timestamptz'), ('text', 'text'), ('hash_tag', 'text'),
+                       ('profile_pic', 'text'), ('created_date_time', 'timestamptz'), ('screen_name', 'text'),
+                       ('user_name', 'text'), ('followers_count', 'bigint'), ('favourites_count', 'bigint'),
+                       ('friends_count', 'bigint'), ('user_id', 'bigint'), ('user_location', 'text'),
+                       ('statuses_count', 'bigint'), ('location', 'geometry'))
+    STAGING_COLUMN_NAMES = ', '.join(name for name, _ in STAGING_COLUMNS)
+
+    CREATE_STAGING_QUERY = f"""
+CREATE TEMP TABLE records_staging ({', '.join(f'{name} {column_type}' for name, column_type in STAGING_COLUMNS)}) 
+ON COMMIT DROP;"""
+
+    COPY_STAGING_QUERY = f"COPY records_staging ({STAGING_COLUMN_NAMES}) FROM STDIN"
+
+    # rows without location keep the location already in records, like INSERT_WITHOUT_LOCATION_QUERY does.
+    # returns the (without location, with location) counts of the merged rows, then the updated and unchanged counts
+    _MERGE_STAGING_TEMPLATE = f"""
+WITH merged AS (
+INSERT INTO records ({STAGING_COLUMN_NAMES}) 
+SELECT DISTINCT ON (id) {STAGING_COLUMN_NAMES} FROM records_staging ORDER BY id 
+ON CONFLICT(id) DO UPDATE 
+SET create_at = excluded.create_at, text = excluded.text, hash_tag = excluded.hash_tag,  
+profile_pic = excluded.profile_pic, created_date_time = excluded.created_date_time,
+screen_name = excluded.screen_name, user_name = excluded.user_name, followers_count = excluded.followers_count, 
+favourites_count = excluded.favourites_count, friends_count= excluded.friends_count, user_id= excluded.user_id, 
+user_location= excluded.user_location, statuses_count= excluded.statuses_count, 
+location = COALESCE(excluded.location, records.location) %s
+RETURNING location IS NOT NULL AS located, xmax = 0 AS inserted) 
+SELECT count(*) FILTER (WHERE NOT located), count(*) FILTER (WHERE located), count(*) FILTER (WHERE NOT inserted), 
+(SELECT count(DISTINCT id) FROM records_staging) - count(*) FROM merged;"""
+    MERGE_STAGING_QUERY = _MERGE_STAGING_TEMPLATE % ''
+    SKIP_UNCHANGED_MERGE_STAGING_QUERY = _MERGE_STAGING_TEMPLATE % f"""
+WHERE ({', '.join('records.' + column for column in UPDATE_COLUMNS + ('location',))}) 
+IS DISTINCT FROM ({', '.join('excluded.' + column for column in UPDATE_COLUMNS)}, 
+COALESCE(excluded.location, records.location))"""
+
+    def __init__(self, skip_unchanged=False):
         super().__init__()
+        self.skip_unchanged = skip_unchanged
         self.inserted_locations_count = 0
         self.inserted_count = 0
+        # known for skip_unchanged inserts and bulk inserts only
+        self.updated_count = 0
+        self.unchanged_count = 0
 
     @staticmethod
     def _insert_ids(ids=List[Tuple[int]]):
@@ -55,50 +124,73 @@ user_location= excluded.user_location, statuses_count= excluded.statuses_count;"
             connection.commit()
             cur.close()
 
-    def insert(self, data_list: List[Union[Dict, int]], id_mode=False) -> None:
-        """inserts the given list into the database"""
+    @staticmethod
+    def _record(data: Dict) -> Tuple:
+        """the values of the record, in the column order of the queries, without location"""
+        return (data['id'], data['date_time'], data['full_text'],
+                ', '.join(data['hashtags']) if data['hashtags'] else None,
+                data['profile_pic'],
+                data['created_date_time'], data['screen_name'], data['user_name'],
+                data['followers_count'], data['favourites_count'],
+                data['friends_count'],
+                data['user_id'], data['user_location'], data['statuses_count'])
+
+    @staticmethod
+    def _centroids(data_list: List[Dict]) -> List[Point]:
+        """centers of the top_left, bottom_right boxes of the whole batch, computed in one pass"""
+        if not data_list:
+            return []
+        corners = np.array([(data['top_left'], data['bottom_right']) for data in data_list], dtype=float)
+        return [Point(long, lat) for long, lat in corners.mean(axis=1).tolist()]
+
+    def _upsert_changed(self, cur, query: str, records: List[Tuple]) -> int:
+        """runs one of the SKIP_UNCHANGED queries, counting updated and unchanged rows, returns the rows written"""
+        if not records:
+            return 0
+        inserted = extras.execute_values(cur, query, records, fetch=True)
+        updated_count = sum(1 for is_inserted, in inserted if not is_inserted)
+        self.updated_count += updated_count
+        self.unchanged_count += len(records) - len(inserted)
+        return len(inserted)
+
+    def insert(self, data_list: List[Union[Dict, int]], id_mode=False) -> bool:
+        """inserts the given list into the database, returns whether it was committed"""
         # construct sql statement to insert data into the records db table
         if id_mode:
             # only insert ids without other data when id_mode == True
             self._insert_ids([(i,) for i in data_list])
+            return True
         else:
             records_with_location = []
             records_without_location = []
+            data_with_location = [data for data in data_list
+                                  if data['top_left'] is not None and data['bottom_right'] is not None]
+            # points are built client side and sent as EWKB, no extra round trip per record
+            geoms = iter(self._centroids(data_with_location))
             for data in data_list:
                 if data['top_left'] is not None and data['bottom_right'] is not None:
                     # form tuples for data with locations
-                    long_tl, lat_tl = data['top_left']
-                    long_br, lat_br = data['bottom_right']
-                    long = (long_tl + long_br) / 2
-                    lat = (lat_br + lat_tl) / 2
-                    geom, = next(Connection.sql_execute(f'select st_makepoint({long},{lat})'))
-                    records_with_location.append((data['id'], data['date_time'], data['full_text'],
-                                                  ', '.join(data['hashtags']) if data['hashtags'] else None,
-                                                  data['profile_pic'],
-                                                  data['created_date_time'], data['screen_name'], data['user_name'],
-                                                  data['followers_count'], data['favourites_count'],
-                                                  data['friends_count'],
-                                                  data['user_id'], data['user_location'], data['statuses_count'], geom))
+                    records_with_location.append(self._record(data) + (next(geoms),))
 
                 else:
-                    records_without_location.append((data['id'], data['date_time'], data['full_text'],
-                                                     ', '.join(data['hashtags']) if data['hashtags'] else None,
-                                                     data['profile_pic'],
-                                                     data['created_date_time'], data['screen_name'], data['user_name'],
-                                                     data['followers_count'], data['favourites_count'],
-                                                     data['friends_count'],
-                                                     data['user_id'], data['user_location'], data['statuses_count']))
+                    records_without_location.append(self._record(data))
 
             try:
                 with Connection() as connection:
                     cur = connection.cursor()
-                    if records_with_location:
-                        extras.execute_values(cur, self.INSERT_WITH_LOCATION_QUERY, records_with_location)
-                        self.inserted_locations_count += cur.rowcount
+                    if self.skip_unchanged:
+                        self.inserted_locations_count += self._upsert_changed(
+                            cur, self.SKIP_UNCHANGED_INSERT_WITH_LOCATION_QUERY, records_with_location)
+                        self.inserted_count += self._upsert_changed(
+                            cur, self.SKIP_UNCHANGED_INSERT_WITHOUT_LOCATION_QUERY, records_without_location)
+                    else:
+                        if records_with_location:
+                            extras.execute_values(cur, self.INSERT_WITH_LOCATION_QUERY, records_with_location)
+                            self.inserted_locations_count += cur.rowcount
 
-                    if records_without_location:
-                        extras.execute_values(cur, self.INSERT_WITHOUT_LOCATION_QUERY, records_without_location)
-                        self.inserted_count += cur.rowcount
+                        if records_without_location:
+                            extras.execute_values(cur, self.INSERT_WITHOUT_LOCATION_QUERY, records_without_location)
+                            self.inserted_count += cur.rowcount
                     # if the data is fetched from db and reprocessed,
                     # the values will be updated with the help of the ON CONFLICT DO UPDATE
                     # if the data is just crawled, the sql statement will just simply insert data into db
@@ -106,22 +198,132 @@ user_location= excluded.user_location, statuses_count= excluded.statuses_count;"
                     cur.close()
             except Exception as err:
                 logger.error(str(err) + traceback.format_exc())
+                return False
             else:
                 logger.info(f'Total data inserted into records: {self.inserted_count}, '
                             f'Total data with locations inserted into records: {self.inserted_locations_count}')
+                return True
+
+    def bulk_insert(self, data_list: List[Dict], binary=True) -> None:
+        """inserts the given list into the database through COPY, for backfills too large for insert
+
+        the records are streamed into a temp staging table, in binary format by default (or text), then merged into
+        records with one upsert, all in one transaction.
+        """
+        if not data_list:
+            return
+        data_with_location = [data for data in data_list
+                              if data['top_left'] is not None and data['bottom_right'] is not None]
+        geoms = iter(self._centroids(data_with_location))
+        records = [self._record(data) + (next(geoms) if data['top_left'] is not None
+                                         and data['bottom_right'] is not None else None,)
+                   for data in data_list]
+
+        if binary:
+            buffer = binary_copy(records, tuple(column_type for _, column_type in self.STAGING_COLUMNS))
+            copy_query = self.COPY_STAGING_QUERY + " (FORMAT binary)"
+        else:
+            buffer = text_copy(records)
+            copy_query = self.COPY_STAGING_QUERY
+
+        try:
+            with Connection() as connection:
+                cur = connection.cursor()
+                cur.execute(self.CREATE_STAGING_QUERY)
+                cur.copy_expert(copy_query, buffer)
+                cur.execute(self.SKIP_UNCHANGED_MERGE_STAGING_QUERY if self.skip_unchanged else self.MERGE_STAGING_QUERY)
+                inserted_count, inserted_locations_count, updated_count, unchanged_count = cur.fetchone()
+                self.inserted_count += inserted_count
+                self.inserted_locations_count += inserted_locations_count
+                self.updated_count += updated_count
+                self.unchanged_count += unchanged_count
+                connection.commit()
+                cur.close()
+        except Exception as err:
+            logger.error(str(err) + traceback.format_exc())
+        else:
+            logger.info(f'Total data inserted into records: {self.inserted_count}, '
+                        f'Total data with locations inserted into records: {self.inserted_locations_count}')
+
+    @staticmethod
+    def _partition_key(data: Union[Dict, int], partition_by: str, partition_count: int):
+        tweet_id = data if isinstance(data, int) else data['id']
+        if partition_by == 'day' and not isinstance(data, int) and data['date_time'] is not None:
+            return data['date_time'].date()
+        return tweet_id % partition_count
+
+    def parallel_insert(self, data_list: List[Union[Dict, int]], id_mode=False, partition_by: str = 'day',
+                        max_workers: int = None, bulk=False) -> None:
+        """inserts the given list over several pooled connections at once, one transaction per partition
+
+        the records are split by partition_by, 'day' (the day of date_time, so that each writer touches one partition
+        of a records table partitioned by create_at) or 'id' (a hash of the id). an id always lands in the same
+        partition, so the concurrent upserts never conflict on a row. max_workers defaults to the pool size, with bulk
+        each partition goes through bulk_insert instead of insert.
+        """
+        if partition_by not in self.PARTITION_KEYS:
+            raise ValueError(f"unknown partition key {partition_by}, expecting one of {self.PARTITION_KEYS}")
+        if not data_list:
+            return
+        max_workers = max_workers or int(Connection.config().get('maxconn', 4))
+        partitions = defaultdict(list)
+        for data in data_list:
+            partitions[self._partition_key(data, partition_by, max_workers)].append(data)
+
+        def write(partition: List[Union[Dict, int]]) -> TweetDumper:
+            # one dumper per partition, its counters are summed up once all are written
+            writer = TweetDumper(self.skip_unchanged)
+            if bulk and not id_mode:
+                writer.bulk_insert(partition)
+            else:
+                writer.insert(partition, id_mode=id_mode)
+            return writer
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(partitions))) as executor:
+            for writer in executor.map(write, partitions.values()):
+                self.inserted_count += writer.inserted_count
+                self.inserted_locations_count += writer.inserted_locations_count
+                self.updated_count += writer.updated_count
+                self.unchanged_count += writer.unchanged_count
+        logger.info(f'Wrote {len(data_list)} records in {len(partitions)} partitions by {partition_by}, {self}')
 
     def report_status(self):
-        return self.inserted_count, self.inserted_locations_count
+        return self.inserted_count, self.inserted_locations_count, self.updated_count, self.unchanged_count
 
     def __str__(self):
         return f'{self.__class__.__name__}{{inserted_records={self.inserted_count}, ' \
-               f'inserted_location_records={self.inserted_locations_count}}}'
+               f'inserted_location_records={self.inserted_locations_count}, ' \
+               f'updated_records={self.updated_count}, unchanged_records={self.unchanged_count}}}'
 
     __repr__ = __str__
 
-    def delete(self, ids: Iterable[int]):
-        for i in ids:
-            Connection.sql_execute_commit(f"update records set deleted = true where id = {i}")
+    def delete(self, ids: Iterable[int], chunk_size: int = DELETE_CHUNK_SIZE) -> int:
+        """marks the given ids as deleted, one statement per chunk of ids, all in one transaction
+
+        returns the number of records marked, 0 if a chunk failed and the transaction was rolled back.
+        """
+        ids = list(ids)
+        if not ids:
+            return 0
+        deleted_count = 0
+        try:
+            with Connection() as connection:
+                try:
+                    cur = connection.cursor()
+                    for start in range(0, len(ids), chunk_size):
+                        cur.execute(self.DELETE_QUERY, (ids[start:start + chunk_size],))
+                        deleted_count += cur.rowcount
+                    connection.commit()
+                    cur.close()
+                except Exception:
+                    # none of the chunks is kept, and the connection goes back to the pool usable
+                    connection.rollback()
+                    raise
+        except Exception as err:
+            logger.error(f'Failed to mark {len(ids)} records as deleted, rolled back: {err}' + traceback.format_exc())
+            return 0
+        logger.info(f'Marked {deleted_count} records as deleted')
+        return deleted_count
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Dict
+
+import numpy as np
+import rootpath
+import shapely
+from shapely.geometry import MultiPolygon, shape
+
+rootpath.append()
+
+from paths import CITY_JSON_PATH, GAZETTEER_DIR
+
+logger = logging.getLogger()
+
+# bump this whenever the on-disk layout changes, old directories are simply ignored.
+GAZETTEER_VERSION = 2
+
+
+class Gazetteer:
+    """
+    Read-only city tables extracted from city.json.
+
+    Each table is a .npy file in a directory keyed by GAZETTEER_VERSION and the hash of city.json, loaded with
+    mmap_mode='r' so that forked workers share the same pages. The i-th row of every table describes the i-th
+    feature of city.json.
+    """
+    TABLES = ('bboxes', 'city_ids', 'county_ids', 'state_ids', 'names', 'county_names', 'state_names')
+    # the city polygons, as the shapely ragged array of a MultiPolygon per city
+    POLYGON_TABLES = ('polygon_coords', 'polygon_ring_offsets', 'polygon_part_offsets', 'polygon_offsets')
+    MANIFEST = 'manifest.json'
+    SOURCES = 'sources.json'
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, self.MANIFEST)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest.get('version') != GAZETTEER_VERSION:
+            raise ValueError(f"gazetteer version mismatch in {directory}")
+        for table in self.TABLES + self.POLYGON_TABLES:
+            setattr(self, table, np.load(os.path.join(directory, f'{table}.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def polygons(self) -> np.ndarray:
+        """returns the array of the real city MultiPolygons, built from the memory-mapped coordinates"""
+        return shapely.from_ragged_array(shapely.GeometryType.MULTIPOLYGON, np.asarray(self.polygon_coords),
+                                         (np.asarray(self.polygon_ring_offsets),
+                                          np.asarray(self.polygon_part_offsets),
+                                          np.asarray(self.polygon_offsets)))
+
+    @classmethod
+    def load(cls, city_json_path: str = CITY_JSON_PATH, cache_dir: str = GAZETTEER_DIR) -> 'Gazetteer':
+        """loads the gazetteer of the given city.json, builds it first if it is not cached yet"""
+        digest = cls._source_digest(city_json_path, cache_dir)
+        directory = os.path.join(cache_dir, f'v{GAZETTEER_VERSION}-{digest[:16]}')
+        if not os.path.exists(os.path.join(directory, cls.MANIFEST)):
+            cls.build(city_json_path, directory, digest)
+        logger.debug(f"loading gazetteer from {directory}")
+        return cls(directory)
+
+    @classmethod
+    def build(cls, city_json_path: str, directory: str, digest: str) -> None:
+        """extracts the tables from city.json, written to a temporary directory first then renamed into place"""
+        import pygeoj
+
+        logger.info(f"building gazetteer from {city_json_path}")
+        columns: Dict[str, list] = {table: list() for table in cls.TABLES}
+        polygons = list()
+        for feature in pygeoj.load(filepath=city_json_path):
+            if feature.properties is None:
+                raise ValueError("no feature properties found, load city.json failed.")
+            bbox = feature.geometry.bbox
+            if bbox is None:
+                raise ValueError("can not find bbox.")
+            columns['bboxes'].append(bbox)
+            columns['city_ids'].append(feature.properties["cityID"])
+            columns['county_ids'].append(feature.properties["countyID"])
+            columns['state_ids'].append(feature.properties["stateID"])
+            columns['names'].append(feature.properties["name"])
+            columns['county_names'].append(feature.properties["countyName"])
+            columns['state_names'].append(feature.properties["stateName"])
+            polygon = shape(feature.geometry.__geo_interface__)
+            polygons.append(MultiPolygon([polygon]) if polygon.geom_type == 'Polygon' else polygon)
+
+        _, columns['polygon_coords'], offsets = shapely.to_ragged_array(polygons)
+        columns.update(zip(cls.POLYGON_TABLES[1:], offsets))
+
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        temp_directory = tempfile.mkdtemp(dir=os.path.dirname(directory))
+        try:
+            for table, values in columns.items():
+                array = np.asarray(values, dtype=float if table == 'bboxes' else None)
+                if array.dtype == object:
+                    raise ValueError(f"can not store mixed typed column {table} of city.json.")
+                np.save(os.path.join(temp_directory, f'{table}.npy'), array, allow_pickle=False)
+            with open(os.path.join(temp_directory, cls.MANIFEST), 'w') as manifest_file:
+                json.dump({'version': GAZETTEER_VERSION, 'source': os.path.abspath(city_json_path),
+                           'sha256': digest, 'count': len(columns['bboxes'])}, manifest_file)
+            os.rename(temp_directory, directory)
+        except OSError:
+            # another process has built the same gazetteer in the meantime
+            if not os.path.exists(os.path.join(directory, cls.MANIFEST)):
+                raise
+        finally:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+        logger.info(f"built gazetteer with {len(columns['bboxes'])} cities into {directory}")
+
+    @classmethod
+    def _source_digest(cls, city_json_path: str, cache_dir: str) -> str:
+        """sha256 of city.json, remembered by (size, mtime) so that the file is only hashed again when it changes"""
+        stat = os.stat(city_json_path)
+        key = os.path.abspath(city_json_path)
+        sources_path = os.path.join(cache_dir, cls.SOURCES)
+        try:
+            with open(sources_path) as sources_file:
+                sources = json.load(sources_file)
+        except (FileNotFoundError, ValueError):
+            sources = dict()
+
+        known = sources.get(key)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+
+        sha256 = hashlib.sha256()
+        with open(city_json_path, 'rb') as source_file:
+            for chunk in iter(lambda: source_file.read(1 << 20), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+
+        sources[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f'{sources_path}.{os.getpid()}'
+        with open(temp_path, 'w') as sources_file:
+            json.dump(sources, sources_file)
+        os.replace(temp_path, sources_path)
+        return digest
@@ -1,150 +1,139 @@
 import json
 import logging.config
-import random
 import time
-from collections import defaultdict
-from enum import Enum
-from typing import Tuple, Optional, Dict
+from collections import defaultdict, namedtuple, OrderedDict
+from typing import Tuple, Optional, Dict, Iterable, List
 
-import pygeoj
+import numpy as np
+import rootpath
+import shapely
 from numpy import mean
-from shapely.geometry import Polygon, Point
 from shapely.strtree import STRtree
-import shelve
 
-from paths import GENERAL_LOG_CONFIG_PATH
+rootpath.append()
 
+from geo_tag.gazetteer import Gazetteer
+from geo_tag.grid_index import GridIndex, US_BOUNDS
+from geo_tag.sampler import BoundingBoxSampler, RandomMode, standardize_bounding_boxes
+from paths import GENERAL_LOG_CONFIG_PATH, US_STATE_ABBREV_PATH
 
-class RandomMode(Enum):
-    """RANDOM mode may lead to different results when you run the same dataSet."""
-    GEO_CENTER = 1
-    UNIFORM_DISTRIBUTION_RANDOM = 2
-    NORMAL_DISTRIBUTION_RANDOM = 3
+logger = logging.getLogger()
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LocationCache:
+    """
+    A bounded LRU memo of normalized location string -> geo_tag.
+
+    None is cached as well, for the locations that can not be resolved.
+    """
+    MAX = 100000
+
+    def __init__(self, maximum_size=MAX):
+        self.maximum_size = maximum_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def normalize(location: str) -> str:
+        """collapses whitespaces, eg. ' Irvine ,CA ' -> 'Irvine, CA'"""
+        return ', '.join(part.strip() for part in ' '.join(location.split()).split(','))
+
+    def get(self, key: str) -> Tuple[bool, Optional[Dict]]:
+        """returns (found, geo_tag)"""
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return True, self._entries[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key: str, geo_tag: Optional[Dict]) -> None:
+        self._entries[key] = geo_tag
+        if len(self._entries) > self.maximum_size:
+            self._entries.popitem(last=False)
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maximum_size, len(self._entries))
 
 
 class TwitterJSONTagger:
 
-    def __init__(self, random_mode=RandomMode.UNIFORM_DISTRIBUTION_RANDOM, sigma=0.01):
+    def __init__(self, random_mode=RandomMode.UNIFORM_DISTRIBUTION_RANDOM, sigma=0.01,
+                 gazetteer: Optional[Gazetteer] = None, location_cache_size=LocationCache.MAX,
+                 seed: Optional[int] = None, use_grid_index=False, exact=False):
         # by default we set UNIFORM_DISTRIBUTION_RANDOM as Point in Polygon.
         self._random_mode = random_mode
         self.sigma = sigma
-        self.shelve = shelve.open('geo_tag.shelve')
+        # pass a seed to get the same random points on every run.
+        self._sampler = BoundingBoxSampler(random_mode, sigma, seed)
+        # exact mode checks the real city polygons after the bbox lookup, instead of taking the first bbox.
+        self._exact = exact
+        self._location_cache = LocationCache(location_cache_size)
         try:
             # self.abbrev_us_state is the relation between the state's full name and abbrev.
-            with open('us_state_abbrev.json') as json_file:
+            with open(US_STATE_ABBREV_PATH) as json_file:
                 self._abbrev_us_state = json.load(json_file)
-            # self.city_datafile is a big json.
-            self._city_json_file = pygeoj.load(filepath="city.json")
+            # city.json is a big json, only parsed when its gazetteer is not cached yet.
+            self._gazetteer = gazetteer if gazetteer is not None else Gazetteer.load()
             # infer on place
             self._init_city_state_mapping()
             # infer on coordinate
             self._init_coord_tree_cache()
+            # optionally answer coordinate lookups from the precomputed grid instead of the tree
+            self._grid_index = GridIndex.load(self._gazetteer) if use_grid_index else None
+            if exact:
+                self._init_polygons()
             # infer on user
             self._init_location_coordinate_mapping()
         except (ValueError, FileExistsError, FileNotFoundError) as err:
             logger.critical(err)
             exit(1)
 
-    def _init_city_state_mapping(self) -> None:
-        """Load city state mapping from file or pickle"""
-        self._city_state_mapping = dict()
-
-        if 'city_state_mapping' in self.shelve:
-            self._city_state_mapping = self.shelve['city_state_mapping']
-            logger.debug("loaded city_state_mapping from geo_tag.shelve")
-        else:
-            logger.debug("extracting features from city json file")
-            for feature in self._city_json_file:
-                # store the city, state as key; (cityID, countyID, stateID, countyName) as value.
-                if feature.properties is not None:
-                    _city_state = feature.properties["name"] + ", " + feature.properties["stateName"]
-                    # key, value
-                    self._city_state_mapping[_city_state] = (
-                        feature.properties["cityID"], feature.properties["countyID"], feature.properties["stateID"],
-                        feature.properties["countyName"])
-                else:
-                    raise ValueError("no feature properties found, load city.json failed.")
+    def _city_state_names(self) -> List[str]:
+        """the "city, state" key of every city in the gazetteer"""
+        return [f'{name}, {state_name}' for name, state_name in
+                zip(self._gazetteer.names.tolist(), self._gazetteer.state_names.tolist())]
 
-            logger.debug("shelving _city_state_mapping")
-            self.shelve['city_state_mapping'] = self._city_state_mapping
-            logger.debug(f"successfully shelved _city_state_mapping")
+    def _init_city_state_mapping(self) -> None:
+        """Load city state mapping from the gazetteer"""
+        # store the city, state as key; (cityID, countyID, stateID, countyName) as value.
+        self._city_state_mapping = dict(zip(self._city_state_names(),
+                                            zip(self._gazetteer.city_ids.tolist(),
+                                                self._gazetteer.county_ids.tolist(),
+                                                self._gazetteer.state_ids.tolist(),
+                                                self._gazetteer.county_names.tolist())))
+        logger.debug("loaded city_state_mapping from the gazetteer")
 
     def _init_coord_tree_cache(self) -> None:
-        """Initialize or read hash map from pickle"""
-        self._coord_mapping = dict()
-        self._geometries = list()
-
-        if 'coord_mapping' in self.shelve and 'geometries' in self.shelve:
-            self._coord_mapping = self.shelve['coord_mapping']
-            logger.debug("loaded coord_mapping from geo_tag.shelve")
-            self._geometries = self.shelve['geometries']
-            logger.debug("loaded geometries from geo_tag.shelve")
-        else:
-            logger.debug("extracting features from city json file")
-            for feature in self._city_json_file:
-                bbox = feature.geometry.bbox
-                if bbox is None:
-                    raise ValueError("can not find bbox.")
-
-                # clockwise, (long, lat)
-                points_list = [Point(bbox[0], bbox[1]), Point(bbox[0], bbox[3]), Point(bbox[2], bbox[3]),
-                               Point(bbox[2], bbox[1])]
-                poly = Polygon(points_list)
-                self._geometries.append(poly)
-                points_tuple = ((bbox[0], bbox[1]), (bbox[0], bbox[3]), (bbox[2], bbox[3]), (bbox[2], bbox[1]))
-
-                self._coord_mapping[points_tuple] = (feature.properties["stateID"], feature.properties["stateName"],
-                                                     feature.properties["countyID"], feature.properties["countyName"],
-                                                     feature.properties["cityID"], feature.properties["name"])
-
-            logger.debug("shelving _coord_mapping")
-            self.shelve['coord_mapping'] = self._coord_mapping
-            logger.debug(f"successfully shelved _coord_mapping")
-            logger.debug("shelving _geometries")
-            self.shelve['geometries'] = self._geometries
-            logger.debug(f"successfully shelved _geometries")
+        """Build the STRtree over the city bboxes of the gazetteer once"""
+        bboxes = self._gazetteer.bboxes
+        self._geometries = shapely.box(bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3])
+        # the tree is immutable, map its indices back to geo_content.
+        self._geometry_contents = list(zip(self._gazetteer.state_ids.tolist(),
+                                           self._gazetteer.state_names.tolist(),
+                                           self._gazetteer.county_ids.tolist(),
+                                           self._gazetteer.county_names.tolist(),
+                                           self._gazetteer.city_ids.tolist(),
+                                           self._gazetteer.names.tolist()))
+        self._coord_tree = STRtree(self._geometries)
+        logger.debug(f"built STRtree over {len(self._geometries)} geometries")
+
+    def _init_polygons(self) -> None:
+        """Load and prepare the real city polygons once, for the exact mode"""
+        self._polygons = self._gazetteer.polygons()
+        shapely.prepare(self._polygons)
+        self._polygon_areas = shapely.area(self._polygons)
+        logger.debug(f"prepared {len(self._polygons)} city polygons")
 
     def _init_location_coordinate_mapping(self) -> None:
-        """Load location_coordinate_mapping from file or pickle"""
-        self._location_coordinate_mapping = dict()
-
-        if 'location_coordinate_mapping' in self.shelve:
-            self._location_coordinate_mapping = self.shelve['location_coordinate_mapping']
-            logger.debug("loaded location_coordinate_mapping from geo_tag.shelve")
-        else:
-            logger.debug("extracting features from city json file")
-            for feature in self._city_json_file:
-                # store the city, state as key; coordinate(bounding_box) as value.
-                bbox = feature.geometry.bbox
-                if feature.properties is not None:
-                    _city_state = feature.properties["name"] + ", " + feature.properties["stateName"]
-                    sw_lng = bbox[0]
-                    sw_lat = bbox[1]
-                    ne_lng = bbox[2]
-                    ne_lat = bbox[3]
-                    sw_lat, sw_lng = self._standardize_bounding_box(ne_lat, ne_lng, sw_lat, sw_lng)
-
-                    # Select Central Point or Random Point in the bounding_box as value each time.
-                    if self._random_mode == RandomMode.GEO_CENTER:
-                        _infer_coord = (sw_lng + ne_lng) / 2.0, (sw_lat + ne_lat) / 2.0
-
-                    elif self._random_mode == RandomMode.UNIFORM_DISTRIBUTION_RANDOM:
-                        _infer_coord = self._uniform_distribute_random_point(ne_lat, ne_lng, sw_lat, sw_lng)
-
-                    elif self._random_mode == RandomMode.NORMAL_DISTRIBUTION_RANDOM:
-                        _infer_coord = self._normal_distribution_random_point(ne_lat, ne_lng, self.sigma, sw_lat,
-                                                                      sw_lng)
-                    else:
-                        raise ValueError("Invalid mode selection in bounding_box.")
-
-                    # key, value
-                    self._location_coordinate_mapping[_city_state] = _infer_coord
-                else:
-                    raise ValueError("no feature properties found, load city.json failed.")
-
-            logger.debug("shelving location_coordinate_mapping")
-            self.shelve['location_coordinate_mapping'] = self._location_coordinate_mapping
-            logger.debug(f"successfully shelved _location_coordinate_mapping")
+        """Select Central Point or Random Point in the bounding_box of every city, all in one batch"""
+        # store the city, state as key; coordinate(bounding_box) as value.
+        points = self._sampler.sample(standardize_bounding_boxes(self._gazetteer.bboxes))
+        self._location_coordinate_mapping = dict(zip(self._city_state_names(), map(tuple, points.tolist())))
 
     def get_coordinate(self, tweet_json: Dict):
         """Returns a longitude, latitude pair found in coordinates or bounding_box with source, returns None if not applicable"""
@@ -172,44 +161,10 @@ class TwitterJSONTagger:
             sw_lat, sw_lng = self._standardize_bounding_box(ne_lat, ne_lng, sw_lat, sw_lng)
 
             # Return Central Point or Random Point in the polygon each time.
-            if self._random_mode == RandomMode.GEO_CENTER:
-                return ((sw_lng + ne_lng) / 2.0, (sw_lat + ne_lat) / 2.0), "bounding_box"
-
-            elif self._random_mode == RandomMode.UNIFORM_DISTRIBUTION_RANDOM:
-                return self._uniform_distribute_random_point(ne_lat, ne_lng, sw_lat, sw_lng), "bounding_box"
-
-            elif self._random_mode == RandomMode.NORMAL_DISTRIBUTION_RANDOM:
-                return self._normal_distribution_random_point(ne_lat, ne_lng, self.sigma, sw_lat, sw_lng), "bounding_box"
-            else:
-                raise ValueError("Invalid mode selection in bounding_box.")
+            return self._sampler.sample_one(ne_lat, ne_lng, sw_lat, sw_lng), "bounding_box"
         else:
             raise ValueError("no place field.")
 
-    @staticmethod
-    def _normal_distribution_random_point(ne_lat, ne_lng, sigma, sw_lat, sw_lng):
-        poly = Polygon([(sw_lng, sw_lat), (ne_lng, sw_lat), (ne_lng, ne_lat), (sw_lng, ne_lat)])
-        # special case, when the polygon is too "tiny"
-        if sw_lng == ne_lng - 0.0000001 and sw_lat == ne_lat - 0.0000001:
-            # we just return it
-            random_point = Point([random.normalvariate(mu=(sw_lng + ne_lng) / 2, sigma=sigma),
-                                  random.normalvariate(mu=(sw_lat + ne_lat) / 2, sigma=sigma)])
-            return random_point.x, random_point.y
-        else:
-            while True:
-                random_point = Point([random.normalvariate(mu=(sw_lng + ne_lng) / 2, sigma=sigma),
-                                      random.normalvariate(mu=(sw_lat + ne_lat) / 2, sigma=sigma)])
-                if random_point.within(poly):
-                    return random_point.x, random_point.y
-
-    @staticmethod
-    def _uniform_distribute_random_point(ne_lat, ne_lng, sw_lat, sw_lng):
-        poly = Polygon([(sw_lng, sw_lat), (ne_lng, sw_lat), (ne_lng, ne_lat), (sw_lng, ne_lat)])
-        while True:
-            random_point = Point([random.uniform(sw_lng, ne_lng), random.uniform(sw_lat, ne_lat)])
-            if random_point.within(poly):
-                # convert from Point to tuple
-                return random_point.x, random_point.y
-
     @staticmethod
     def _standardize_bounding_box(ne_lat, ne_lng, sw_lat, sw_lng):
         # The AsterixDB is unhappy with this kind of point "rectangular"
@@ -275,44 +230,111 @@ class TwitterJSONTagger:
         else:
             logger.debug("place is None.")
 
+    @staticmethod
+    def _in_usa(lng, lat):
+        """only consider USA"""
+        min_lng, min_lat, max_lng, max_lat = US_BOUNDS
+        return (lng <= max_lng) & (lng >= min_lng) & (lat >= min_lat) & (lat <= max_lat)
+
+    @staticmethod
+    def _build_coord_geo_tag(geo_content: tuple, coord: tuple, coord_source: str) -> Dict:
+        geo_tag = dict()
+        geo_tag["stateID"] = geo_content[0]
+        geo_tag["stateName"] = geo_content[1]
+        geo_tag["countyID"] = geo_content[2]
+        geo_tag["countyName"] = geo_content[3]
+        geo_tag["cityID"] = geo_content[4]
+        geo_tag["cityName"] = geo_content[5]
+        geo_tag["coordinate"] = coord
+        geo_tag["coordinate_source"] = coord_source
+        geo_tag["source"] = "coordinate"
+        return geo_tag
+
+    def _candidates(self, points_array: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """first pass, returns every (point index, city index) pair where the city bbox contains the point"""
+        if self._grid_index is not None:
+            return self._grid_index.query_all(points_array)
+
+        # ret[0] indexes into points_array, ret[1] indexes into self._geometries, ordered by ret[0]
+        ret = self._coord_tree.query(shapely.points(points_array), predicate="intersects")
+        return ret[0], ret[1]
+
+    def _locate(self, points_array: np.ndarray) -> np.ndarray:
+        """returns the index into self._geometries of the city containing each (long, lat) point, -1 if none"""
+        located = np.full(len(points_array), -1, dtype=np.int64)
+        point_indices, city_indices = self._candidates(points_array)
+
+        if self._exact:
+            # second pass, keep the pairs where the real city polygon contains the point
+            hits = shapely.contains_xy(self._polygons[city_indices],
+                                       points_array[point_indices, 0], points_array[point_indices, 1])
+            point_indices, city_indices = point_indices[hits], city_indices[hits]
+            # the smallest, most specific city first
+            order = np.lexsort((city_indices, self._polygon_areas[city_indices], point_indices))
+            point_indices, city_indices = point_indices[order], city_indices[order]
+
+        # we just pick the first hit of each point as the inferred result.
+        hit_indices, first_positions = np.unique(point_indices, return_index=True)
+        located[hit_indices] = city_indices[first_positions]
+        return located
+
     def _infer_geo_from_coord(self, coord: tuple, coord_source: str) -> Optional[Dict]:
 
-        # only consider USA
-        if coord[0] > -68 or coord[0] < -162 or coord[1] < 19 or coord[1] > 65:
+        if not self._in_usa(coord[0], coord[1]):
             raise ValueError("this location is not in USA.")
 
-        # traverse the hash map to see if this coord is in the tree.
-        geo_content = tuple()
-        cache_tree = STRtree(self._geometries)
-        query_geom = Point(*coord)
-
-        # ret is a list
-        ret = cache_tree.query(query_geom)
-        if not ret:
-            raise ValueError("can not find location in STRTREE.")
+        index, = self._locate(np.array([coord], dtype=float))
+        if index < 0:
+            raise ValueError("can not find location in the coordinate index.")
 
-        # we just pick the first one in the list as the inferred result.
-        target = tuple(ret[0].exterior.coords[:-1])
-        if self._coord_mapping.get(target):
-            geo_content = self._coord_mapping[target]
+        geo_content = self._geometry_contents[index]
 
         if geo_content:
-            geo_tag = dict()
-            geo_tag["stateID"] = geo_content[0]
-            geo_tag["stateName"] = geo_content[1]
-            geo_tag["countyID"] = geo_content[2]
-            geo_tag["countyName"] = geo_content[3]
-            geo_tag["cityID"] = geo_content[4]
-            geo_tag["cityName"] = geo_content[5]
-            geo_tag["coordinate"] = coord
-            geo_tag["coordinate_source"] = coord_source
-            geo_tag["source"] = "coordinate"
-
-            return geo_tag
+            return self._build_coord_geo_tag(geo_content, coord, coord_source)
 
         else:
             raise ValueError("can not load geo_content.")
 
+    def _infer_geo_from_coords(self, coords: List[tuple], coord_sources: List[str]) -> List[Optional[Dict]]:
+        """batch version of _infer_geo_from_coord, resolves all coords with one bulk index query.
+
+        returns a geo_tag for each coord, None where the coord can not be tagged.
+        """
+        geo_tags: List[Optional[Dict]] = [None] * len(coords)
+        # a malformed coord is left untagged instead of failing the whole batch
+        points, positions = [], []
+        for i, coord in enumerate(coords):
+            point = self._parse_coord(coord)
+            if point is None:
+                logger.debug(f"can not parse coordinate {coord!r}")
+            else:
+                points.append(point)
+                positions.append(i)
+        if not points:
+            return geo_tags
+
+        points_array = np.array(points, dtype=float)
+        candidates = np.flatnonzero(self._in_usa(points_array[:, 0], points_array[:, 1]))
+        if not len(candidates):
+            return geo_tags
+
+        for candidate, index in zip(candidates.tolist(), self._locate(points_array[candidates]).tolist()):
+            if index >= 0 and self._geometry_contents[index]:
+                i = positions[candidate]
+                geo_tags[i] = self._build_coord_geo_tag(self._geometry_contents[index], coords[i], coord_sources[i])
+        return geo_tags
+
+    @staticmethod
+    def _parse_coord(coord) -> Optional[Tuple[float, float]]:
+        """returns the coord as a finite (lng, lat), None if it is not one"""
+        try:
+            lng, lat = map(float, coord)
+        except (TypeError, ValueError):
+            return None
+        if not (np.isfinite(lng) and np.isfinite(lat)):
+            return None
+        return lng, lat
+
     def _infer_geo_from_user(self, tweet_json) -> Optional[dict]:
         '''we know that coord is None.'''
         user = tweet_json.get('user')
@@ -326,12 +348,29 @@ class TwitterJSONTagger:
             if not self._location_coordinate_mapping:
                 self._init_location_coordinate_mapping()
 
-            return self._extract_geo_tag_from_city_and_state(None, '', city_state_name, "user_profile")
+            city_state_name = LocationCache.normalize(city_state_name)
+            found, geo_tag = self._location_cache.get(city_state_name)
+            if not found:
+                try:
+                    geo_tag = self._extract_geo_tag_from_city_and_state(None, '', city_state_name, "user_profile")
+                except (KeyError, ValueError) as err:
+                    # cache the unresolvable location too, so that it is only logged once.
+                    logger.debug(f"can not resolve user location {city_state_name!r}: {err!r}")
+                    geo_tag = None
+                self._location_cache.put(city_state_name, geo_tag)
+
+            # copied since the geo_tag is shared by all tweets of the same location
+            return dict(geo_tag) if geo_tag is not None else None
         else:
             logger.debug("no user field.")
             return None
 
-    def tag_one_tweet(self, tweet_json: Dict) -> Dict:
+    def location_cache_info(self) -> CacheInfo:
+        """hits, misses and size of the user location cache"""
+        return self._location_cache.info()
+
+    def _tag_by_place(self, tweet_json: Dict) -> Tuple[Optional[tuple], str]:
+        """step 1, tags the tweet from its place field, returns the coordinate found for the later steps"""
         logger.debug("-----------------------------------------")
         logger.debug(f"tweet id: {tweet_json['id']}")
         coord = None
@@ -343,6 +382,31 @@ class TwitterJSONTagger:
             tweet_json['geo_tag'] = self._infer_geo_from_place(tweet_json, coord, coord_source)
         except (KeyError, ValueError) as err:
             logger.debug(err)
+        return coord, coord_source
+
+    def _tag_by_user(self, tweet_json: Dict) -> None:
+        # 3. infer from the "User" field
+        try:
+            tweet_json['geo_tag'] = self._infer_geo_from_user(tweet_json)
+        except (KeyError, ValueError) as err:
+            logger.debug(err)
+
+    @staticmethod
+    def _finish_tagging(tweet_json: Dict) -> Dict:
+        if 'geo_tag' in tweet_json:
+            logger.info(tweet_json['geo_tag'])
+
+        # The methods above are all not working, for now we skip.
+        # TODO: Use NLP to infer geo_tag from text in tweet.
+        if 'geo_tag' not in tweet_json:
+            tweet_json['geo_tag'] = None
+        # Return None for exceptions.
+        assert 'geo_tag' in tweet_json, "failed to tag geo information."
+
+        return tweet_json
+
+    def tag_one_tweet(self, tweet_json: Dict) -> Dict:
+        coord, coord_source = self._tag_by_place(tweet_json)
 
         # step 1 failed.
         if tweet_json.get('geo_tag') is None:
@@ -354,27 +418,38 @@ class TwitterJSONTagger:
                 except (KeyError, ValueError) as err:
                     logger.debug(err)
             else:
-                # 3. infer from the "User" field
-                try:
-                    tweet_json['geo_tag'] = self._infer_geo_from_user(tweet_json)
-                except (KeyError, ValueError) as err:
-                    logger.debug(err)
+                self._tag_by_user(tweet_json)
 
-        if 'geo_tag' in tweet_json:
-            logger.info(tweet_json['geo_tag'])
+        return self._finish_tagging(tweet_json)
 
-        # The methods above are all not working, for now we skip.
-        # TODO: Use NLP to infer geo_tag from text in tweet.
-        if 'geo_tag' not in tweet_json:
-            tweet_json['geo_tag'] = None
-        # Return None for exceptions.
-        assert 'geo_tag' in tweet_json, "failed to tag geo information."
+    def tag_many(self, tweets: Iterable[Dict]) -> List[Dict]:
+        """tags a batch of tweets, same result as tag_one_tweet on each of them.
 
-        return tweet_json
+        coordinates of the tweets that failed on place are collected and resolved with one bulk tree query.
+        """
+        tweets = list(tweets)
+        pending = list()
+        for tweet_json in tweets:
+            coord, coord_source = self._tag_by_place(tweet_json)
+
+            # step 1 failed.
+            if tweet_json.get('geo_tag') is None:
+                if coord:
+                    # 2. Check the coordinate, deferred to the bulk query below.
+                    pending.append((tweet_json, coord, coord_source))
+                else:
+                    self._tag_by_user(tweet_json)
+
+        geo_tags = self._infer_geo_from_coords([coord for _, coord, _ in pending],
+                                               [coord_source for _, _, coord_source in pending])
+        for (tweet_json, _, _), geo_tag in zip(pending, geo_tags):
+            tweet_json['geo_tag'] = geo_tag
 
+        return [self._finish_tagging(tweet_json) for tweet_json in tweets]
 
 if __name__ == '__main__':
-    # for debug
+    # for debug, run from the repository root as `python -m geo_tag.geo_tag`, reading the tweets of ./test.
+    # `python geo_tag/geo_tag.py` can not import the geo_tag package, as it finds this file under that name first.
     logging.config.fileConfig(GENERAL_LOG_CONFIG_PATH)
     logger = logging.getLogger()
 
@@ -417,4 +492,5 @@ if __name__ == '__main__':
                 start_time = time.perf_counter()
 
     print(counters)
+    print(twitter_json_tagger.location_cache_info())
     print("average performance for 100 tweets: ", mean(performance), "s")
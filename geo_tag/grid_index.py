@@ -0,0 +1,116 @@
+import logging
+import os
+from typing import Tuple
+
+import numpy as np
+import rootpath
+
+rootpath.append()
+
+from geo_tag.gazetteer import Gazetteer
+
+logger = logging.getLogger()
+
+# (min_lng, min_lat, max_lng, max_lat) of the USA, coordinates out of it are not tagged.
+US_BOUNDS = (-162.0, 19.0, -68.0, 65.0)
+
+
+class GridIndex:
+    """
+    A fixed resolution grid over US_BOUNDS, each cell lists the gazetteer rows whose bbox overlaps the cell.
+
+    The cells are stored as CSR arrays: the candidates of cell c are members[offsets[c]:offsets[c + 1]], in gazetteer
+    order. Both arrays are saved next to the gazetteer tables and memory-mapped the same way.
+    """
+    RESOLUTION = 0.1
+
+    def __init__(self, bboxes: np.ndarray, offsets: np.ndarray, members: np.ndarray, resolution: float = RESOLUTION,
+                 bounds: Tuple[float, float, float, float] = US_BOUNDS):
+        self.bboxes = bboxes
+        self.offsets = offsets
+        self.members = members
+        self.resolution = resolution
+        self.bounds = bounds
+        self.shape = self._shape(bounds, resolution)
+
+    @classmethod
+    def load(cls, gazetteer: Gazetteer, resolution: float = RESOLUTION) -> 'GridIndex':
+        """loads the grid of the gazetteer, builds it first if it is not saved yet"""
+        offsets_path, members_path = (os.path.join(gazetteer.directory, f'grid-{resolution:g}-{table}.npy')
+                                      for table in ('offsets', 'members'))
+        if not (os.path.exists(offsets_path) and os.path.exists(members_path)):
+            offsets, members = cls.build(gazetteer.bboxes, resolution)
+            # members first, the offsets file marks a complete grid
+            for path, array in ((members_path, members), (offsets_path, offsets)):
+                temp_path = f'{path}.{os.getpid()}.npy'
+                np.save(temp_path, array, allow_pickle=False)
+                os.replace(temp_path, path)
+        logger.debug(f"loading grid index from {gazetteer.directory}")
+        return cls(gazetteer.bboxes, np.load(offsets_path, mmap_mode='r'), np.load(members_path, mmap_mode='r'),
+                   resolution)
+
+    @classmethod
+    def build(cls, bboxes: np.ndarray, resolution: float = RESOLUTION,
+              bounds: Tuple[float, float, float, float] = US_BOUNDS) -> Tuple[np.ndarray, np.ndarray]:
+        """returns the (offsets, members) CSR arrays of the bboxes over the grid"""
+        columns, rows = cls._shape(bounds, resolution)
+        bboxes = np.asarray(bboxes, dtype=float)
+        # cell range of every bbox, clipped to the grid
+        first_columns, first_rows = cls._cell_coords(bboxes[:, :2], resolution, bounds)
+        last_columns, last_rows = cls._cell_coords(bboxes[:, 2:], resolution, bounds)
+        overlapping = np.flatnonzero((bboxes[:, 2] >= bounds[0]) & (bboxes[:, 0] <= bounds[2]) &
+                                     (bboxes[:, 3] >= bounds[1]) & (bboxes[:, 1] <= bounds[3]))
+
+        cells, members = list(), list()
+        for i in overlapping:
+            column_range = np.arange(first_columns[i], last_columns[i] + 1)
+            row_range = np.arange(first_rows[i], last_rows[i] + 1)
+            bbox_cells = (row_range[:, None] * columns + column_range[None, :]).ravel()
+            cells.append(bbox_cells)
+            members.append(np.full(len(bbox_cells), i, dtype=np.int32))
+
+        cells = np.concatenate(cells) if cells else np.empty(0, dtype=np.int64)
+        members = np.concatenate(members) if members else np.empty(0, dtype=np.int32)
+        # stable sort keeps the gazetteer order inside each cell
+        order = np.argsort(cells, kind='stable')
+        offsets = np.zeros(columns * rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=columns * rows), out=offsets[1:])
+        logger.info(f"built grid index of {columns}x{rows} cells, {len(members)} entries")
+        return offsets, members[order]
+
+    def query_all(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """returns every (point index, gazetteer row) pair where the bbox of the row contains the point,
+        ordered by point index, then by gazetteer row"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        inside = np.flatnonzero((points[:, 0] >= self.bounds[0]) & (points[:, 0] <= self.bounds[2]) &
+                                (points[:, 1] >= self.bounds[1]) & (points[:, 1] <= self.bounds[3]))
+
+        columns, rows = self._cell_coords(points[inside], self.resolution, self.bounds)
+        cells = rows * self.shape[0] + columns
+        starts = self.offsets[cells]
+        counts = self.offsets[cells + 1] - starts
+
+        # expand every point into its candidates
+        point_indices = np.repeat(inside, counts)
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        candidates = self.members[positions].astype(np.int64)
+        candidate_bboxes = self.bboxes[candidates]
+        candidate_points = points[point_indices]
+        hits = ((candidate_points[:, 0] >= candidate_bboxes[:, 0]) & (candidate_points[:, 0] <= candidate_bboxes[:, 2]) &
+                (candidate_points[:, 1] >= candidate_bboxes[:, 1]) & (candidate_points[:, 1] <= candidate_bboxes[:, 3]))
+        return point_indices[hits], candidates[hits]
+
+    @staticmethod
+    def _shape(bounds: Tuple[float, float, float, float], resolution: float) -> Tuple[int, int]:
+        """(columns, rows) of the grid"""
+        return (int(np.ceil((bounds[2] - bounds[0]) / resolution)) + 1,
+                int(np.ceil((bounds[3] - bounds[1]) / resolution)) + 1)
+
+    @classmethod
+    def _cell_coords(cls, points: np.ndarray, resolution: float,
+                     bounds: Tuple[float, float, float, float]) -> Tuple[np.ndarray, np.ndarray]:
+        """(column, row) of the cells the points fall in, clipped to the grid"""
+        columns, rows = cls._shape(bounds, resolution)
+        column = np.clip(np.floor((points[:, 0] - bounds[0]) / resolution), 0, columns - 1).astype(np.int64)
+        row = np.clip(np.floor((points[:, 1] - bounds[1]) / resolution), 0, rows - 1).astype(np.int64)
+        return column, row
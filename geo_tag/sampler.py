@@ -0,0 +1,80 @@
+from enum import Enum
+from typing import Optional, Tuple
+
+import numpy as np
+
+# The AsterixDB is unhappy with point "rectangular", such bboxes are widened by this much.
+MIN_EXTENT = 0.0000001
+
+
+class RandomMode(Enum):
+    """RANDOM mode may lead to different results when you run the same dataSet."""
+    GEO_CENTER = 1
+    UNIFORM_DISTRIBUTION_RANDOM = 2
+    NORMAL_DISTRIBUTION_RANDOM = 3
+
+
+def standardize_bounding_boxes(bboxes: np.ndarray) -> np.ndarray:
+    """returns a copy of the (n, 4) [sw_lng, sw_lat, ne_lng, ne_lat] array with point bboxes widened to MIN_EXTENT"""
+    bboxes = np.array(bboxes, dtype=float).reshape(-1, 4)
+    points = (bboxes[:, 0] == bboxes[:, 2]) & (bboxes[:, 1] == bboxes[:, 3])
+    bboxes[points, 0] = bboxes[points, 2] - MIN_EXTENT
+    bboxes[points, 1] = bboxes[points, 3] - MIN_EXTENT
+    invalid = (bboxes[:, 0] > bboxes[:, 2]) | (bboxes[:, 1] > bboxes[:, 3])
+    if invalid.any():
+        raise ValueError(f"Invalid coordinates in bounding_box: {bboxes[invalid][0].tolist()}")
+    return bboxes
+
+
+class BoundingBoxSampler:
+    """
+    Picks one point per bounding box for a whole batch of bboxes at once, according to the RandomMode.
+
+    Uses its own numpy Generator, runs with the same seed pick the same points.
+    """
+    MAX_REJECTION_ROUNDS = 1000
+
+    def __init__(self, random_mode=RandomMode.UNIFORM_DISTRIBUTION_RANDOM, sigma=0.01, seed: Optional[int] = None):
+        if not isinstance(random_mode, RandomMode):
+            raise ValueError("Invalid mode selection in bounding_box.")
+        self.random_mode = random_mode
+        self.sigma = sigma
+        self.rng = np.random.default_rng(seed)
+
+    def sample(self, bboxes: np.ndarray) -> np.ndarray:
+        """returns an (n, 2) array of (long, lat) for the (n, 4) array of standardized bboxes"""
+        bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+        sw, ne = bboxes[:, :2], bboxes[:, 2:]
+
+        if self.random_mode == RandomMode.GEO_CENTER:
+            return (sw + ne) / 2.0
+
+        elif self.random_mode == RandomMode.UNIFORM_DISTRIBUTION_RANDOM:
+            # every point drawn from the bbox is in the bbox, no rejection needed
+            return self.rng.uniform(sw, ne)
+
+        else:
+            return self._sample_normal(sw, ne)
+
+    def sample_one(self, ne_lat, ne_lng, sw_lat, sw_lng) -> Tuple[float, float]:
+        """single bbox version of sample, returns a (long, lat) tuple"""
+        long, lat = self.sample(np.array([sw_lng, sw_lat, ne_lng, ne_lat]))[0].tolist()
+        return long, lat
+
+    def _sample_normal(self, sw: np.ndarray, ne: np.ndarray) -> np.ndarray:
+        """normal distribution around the centers, re-drawing only the points that fall out of their bbox"""
+        centers = (sw + ne) / 2.0
+        points = self.rng.normal(centers, self.sigma)
+        # special case, when the bbox is too "tiny", we just take the point
+        tiny = np.all(ne - sw < 2 * MIN_EXTENT, axis=1)
+        outside = ~tiny & np.any((points <= sw) | (points >= ne), axis=1)
+
+        for _ in range(self.MAX_REJECTION_ROUNDS):
+            if not outside.any():
+                break
+            points[outside] = self.rng.normal(centers[outside], self.sigma)
+            outside[outside] = np.any((points[outside] <= sw[outside]) | (points[outside] >= ne[outside]), axis=1)
+        else:
+            # sigma is far larger than these bboxes, fall back to uniform points inside them
+            points[outside] = self.rng.uniform(sw[outside], ne[outside])
+        return points
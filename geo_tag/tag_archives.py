@@ -0,0 +1,261 @@
+import argparse
+import ast
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from collections import defaultdict
+from itertools import islice
+from multiprocessing import Pool
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import rootpath
+
+rootpath.append()
+
+from geo_tag.gazetteer import Gazetteer
+from geo_tag.geo_tag import TwitterJSONTagger
+from geo_tag.sampler import RandomMode
+from paths import BACKUP_DIR, CITY_JSON_PATH
+
+logger = logging.getLogger()
+
+# (archive path, first line, last line exclusive or None for the end of file)
+Unit = Tuple[str, int, Optional[int]]
+# (unit, pid, tagged tweet count, skipped line count, seconds, error or None if the unit is complete)
+UnitResult = Tuple[Unit, int, int, int, float, Optional[str]]
+
+_tagger: Optional[TwitterJSONTagger] = None
+
+
+def _init_worker(gazetteer_directory: str, tagger_options: Dict) -> None:
+    """builds the tagger of this worker on top of the memory-mapped gazetteer, shared with the other workers.
+
+    main builds one tagger first with the same arguments, a failing initializer would be respawned by the pool forever.
+    """
+    global _tagger
+    _tagger = TwitterJSONTagger(gazetteer=Gazetteer(gazetteer_directory), **tagger_options)
+
+
+def _output_path(output_dir: str, unit: Unit) -> str:
+    path, start, _ = unit
+    name = os.path.basename(path)
+    if name.endswith('.gz'):
+        name = name[:-len('.gz')]
+    return os.path.join(output_dir, f'{name}.{start}.jsonl')
+
+
+def _read_checkpoint(checkpoint_path: str) -> Dict:
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except (FileNotFoundError, ValueError):
+        return {'lines': 0, 'bytes': 0, 'complete': False}
+
+
+def _write_checkpoint(checkpoint_path: str, checkpoint: Dict) -> None:
+    temp_path = f'{checkpoint_path}.tmp'
+    with open(temp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temp_path, checkpoint_path)
+
+
+def _parse_line(line: bytes) -> Optional[Dict]:
+    """archives hold both json strings and python reprs of dicts, one tweet per line"""
+    try:
+        text = line.decode('utf-8').strip()
+    except UnicodeDecodeError:
+        logger.error(f"can not decode archive line: {line[:100]!r}")
+        return None
+    if not text:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        try:
+            return ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            logger.error(f"can not parse archive line: {text[:100]}")
+            return None
+
+
+def _batches(lines: Iterable[bytes], batch_size: int) -> Iterator[List[bytes]]:
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def tag_unit(unit: Unit, output_dir: str, batch_size: int, lines: Optional[List[bytes]] = None) -> UnitResult:
+    """tags one unit from its checkpoint on, given the lines of the unit or reading them from the archive.
+
+    an error, e.g. an archive truncated while it is appended to, fails the unit only. its checkpoint stays incomplete
+    so that a rerun picks it up again.
+    """
+    path, start, _ = unit
+    output_path = _output_path(output_dir, unit)
+    checkpoint_path = f'{output_path}.checkpoint'
+    checkpoint = _read_checkpoint(checkpoint_path)
+    if checkpoint['complete']:
+        return unit, os.getpid(), 0, 0, 0.0, None
+
+    # tagged tweets, skipped lines
+    counts = [0, 0]
+    start_time = time.perf_counter()
+    try:
+        _tag_lines(unit, output_path, checkpoint_path, checkpoint, batch_size, lines, counts)
+    except Exception as err:
+        logger.error(f"tagging {path}:{start} failed: {err!r}")
+        return unit, os.getpid(), counts[0], counts[1], time.perf_counter() - start_time, repr(err)
+    count, skipped = counts
+    if skipped:
+        logger.warning(f"skipped {skipped} lines of {path}:{start} that are not tweet objects")
+    return unit, os.getpid(), count, skipped, time.perf_counter() - start_time, None
+
+
+def _tag_lines(unit: Unit, output_path: str, checkpoint_path: str, checkpoint: Dict, batch_size: int,
+               lines: Optional[List[bytes]], counts: List[int]) -> None:
+    """tags the lines of the unit after its checkpoint, adding to counts the tagged tweets and skipped lines"""
+    path, start, stop = unit
+    with open(output_path, 'ab') as output:
+        # drop whatever was written after the last checkpoint
+        output.truncate(checkpoint['bytes'])
+        output.seek(checkpoint['bytes'])
+        archive = gzip.open(path, 'rb') if lines is None else None
+        try:
+            if archive is not None:
+                lines = islice(archive, start + checkpoint['lines'], stop)
+            else:
+                lines = islice(lines, checkpoint['lines'], None)
+            for batch in _batches(lines, batch_size):
+                tweets = list()
+                for tweet in map(_parse_line, batch):
+                    # lines that parse to something else than a tweet dict, e.g. a bare number or list
+                    if tweet is not None and not isinstance(tweet, dict):
+                        counts[1] += 1
+                    elif tweet is not None and tweet.get('id'):
+                        tweets.append(tweet)
+                for tweet in _tagger.tag_many(tweets):
+                    output.write(json.dumps(tweet, default=str).encode('utf-8') + b'\n')
+                output.flush()
+                os.fsync(output.fileno())
+                counts[0] += len(tweets)
+                checkpoint['lines'] += len(batch)
+                checkpoint['bytes'] = output.tell()
+                _write_checkpoint(checkpoint_path, checkpoint)
+        finally:
+            if archive is not None:
+                archive.close()
+
+    checkpoint['complete'] = True
+    _write_checkpoint(checkpoint_path, checkpoint)
+
+
+def _units(paths: List[str], chunk_lines: Optional[int],
+           failed: List[Tuple[Unit, str]]) -> Iterator[Tuple[Unit, Optional[List[bytes]]]]:
+    """yields the units to tag with their lines, None for whole archives that the workers read themselves.
+
+    in chunked mode every archive is decompressed once, here, and only its lines are handed to the workers.
+    """
+    for path in paths:
+        if not chunk_lines:
+            yield (path, 0, None), None
+            continue
+        start = 0
+        try:
+            with gzip.open(path, 'rb') as archive:
+                for lines in _batches(archive, chunk_lines):
+                    yield (path, start, start + len(lines)), lines
+                    start += len(lines)
+        except (OSError, EOFError) as err:
+            # the chunks read before the error are still tagged, the rest of the archive is reported as failed
+            logger.error(f"reading {path} failed at line {start}: {err!r}")
+            failed.append(((path, start, None), repr(err)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="geo-tag the backup archives in parallel, each archive (or each --chunk-lines lines of it) is "
+                    "tagged into its own JSONL file, rerun with the same arguments to resume from the checkpoints. "
+                    "run from the repository root as python -m geo_tag.tag_archives")
+    parser.add_argument('archives', nargs='*', help=f"gz archives, defaults to {BACKUP_DIR}/*.gz")
+    parser.add_argument('--output-dir', required=True, help="directory of the tagged JSONL files and checkpoints")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-lines', type=int, default=None,
+                        help="split archives into units of this many lines, by default one unit per archive")
+    parser.add_argument('--batch-size', type=int, default=1000, help="tweets per tag_many call and checkpoint")
+    parser.add_argument('--city-json', default=CITY_JSON_PATH)
+    parser.add_argument('--random-mode', choices=[mode.name for mode in RandomMode],
+                        default=RandomMode.UNIFORM_DISTRIBUTION_RANDOM.name)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--grid', action='store_true', help="use the precomputed grid index")
+    parser.add_argument('--exact', action='store_true', help="check the real city polygons")
+    args = parser.parse_args()
+
+    paths = sorted(args.archives or glob.glob(os.path.join(BACKUP_DIR, '*.gz')))
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # built or loaded once here, the workers only map the files
+    gazetteer = Gazetteer.load(args.city_json)
+    if args.grid:
+        from geo_tag.grid_index import GridIndex
+        GridIndex.load(gazetteer)
+    tagger_options = {'random_mode': RandomMode[args.random_mode], 'seed': args.seed,
+                      'use_grid_index': args.grid, 'exact': args.exact}
+    # fails here, once, if the gazetteer or the tagger data is unusable, instead of in every worker the pool restarts
+    TwitterJSONTagger(gazetteer=gazetteer, **tagger_options)
+
+    print(f"tagging {len(paths)} archives with {args.processes} processes")
+    worker_counts = defaultdict(int)
+    worker_seconds = defaultdict(float)
+    skipped_count = 0
+    failed: List[Tuple[Unit, str]] = list()
+    results: queue.Queue = queue.Queue()
+
+    def report(result: UnitResult) -> None:
+        nonlocal skipped_count
+        unit, pid, count, skipped, seconds, error = result
+        worker_counts[pid] += count
+        worker_seconds[pid] += seconds
+        skipped_count += skipped
+        if error is not None:
+            failed.append((unit, error))
+            print(f"[worker {pid}] {unit[0]}:{unit[1]} failed after {count} tweets: {error}")
+            return
+        rate = count / seconds if seconds else 0.0
+        print(f"[worker {pid}] {unit[0]}:{unit[1]} {count} tweets, {rate:.1f} tweets/sec, "
+              f"total {worker_counts[pid] / max(worker_seconds[pid], 1e-9):.1f} tweets/sec")
+
+    start_time = time.perf_counter()
+    with Pool(args.processes, initializer=_init_worker, initargs=(gazetteer.directory, tagger_options)) as pool:
+        # at most this many units, with their lines in chunked mode, are held in memory
+        window = 2 * args.processes
+        in_flight = 0
+        for unit, lines in _units(paths, args.chunk_lines, failed):
+            while in_flight >= window:
+                report(results.get())
+                in_flight -= 1
+            pool.apply_async(tag_unit, (unit, args.output_dir, args.batch_size, lines), callback=results.put,
+                             error_callback=lambda err, unit=unit: results.put((unit, 0, 0, 0, 0.0, repr(err))))
+            in_flight += 1
+        for _ in range(in_flight):
+            report(results.get())
+
+    elapsed = time.perf_counter() - start_time
+    total = sum(worker_counts.values())
+    print(f"tagged {total} tweets in {elapsed:.1f}s, {total / max(elapsed, 1e-9):.1f} tweets/sec, "
+          f"skipped {skipped_count} lines that are not tweet objects")
+    if failed:
+        print(f"{len(failed)} units failed, rerun to resume them:")
+        for (path, start, _), error in failed:
+            print(f"  {path}:{start} {error}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 import logging
 import logging.config
 import os
-import pickle
 import sys
 import time
 from multiprocessing import Process, Lock
@@ -15,26 +14,35 @@ from crawler.twitter_search_api_crawler import TweetSearchAPICrawler
 from extractor.twitter_extractor import TweetExtractor
 from paths import TWITTER_TEXT_CACHE, LOG_DIR, BACKUP_DIR, CACHE_DIR
 from utilities.cacheset import CacheSet
+from utilities.id_filter import SharedIdFilter
+from utilities.id_log import IdLog
 # from utilities.connection import Connection
 
-try:
-    cache: CacheSet[int] = pickle.load(open(TWITTER_TEXT_CACHE, 'rb+'))
-except:
-    cache = CacheSet()
+# loaded on first use by the modes that need it, see _id_cache
+id_log = IdLog(TWITTER_TEXT_CACHE)
+
+
+def _id_cache() -> CacheSet:
+    """returns the id cache, loading the snapshot and replaying the log on the first call"""
+    if id_log.cache is None:
+        id_log.load()
+    return id_log.cache
 
 
 def _fetch_id_from_db():
     """a generator which generates 100 id list at a time"""
     result = list()
-    # for id, in Connection.sql_execute(
+    # cache = _id_cache()
+    # for id, in Connection.sql_stream(
     #         f"SELECT id FROM records WHERE create_at IS NULL and deleted IS NOT TRUE ORDER BY id DESC"):
     #     if id not in cache:
     #         cache.add(id)
     #         result.append(id)
     #     if len(result) == 100:
+    #         id_log.append(result)
     #         yield result
     #         result.clear()
-    # pickle.dump(cache, open(TWITTER_TEXT_CACHE, 'wb+'))
+    # id_log.append(result)
     yield result
 
 
@@ -42,24 +50,28 @@ def start(mode):
     # tweet_dumper = TweetDumper()
     tweet_extractor = TweetExtractor()
     if mode == "filter_mode":
-        tweet_filter_api_crawler = TweetFilterAPICrawler()
-        while True:
-            keywords = read_keywords()
-            ids = tweet_filter_api_crawler.crawl(keywords, batch_number=100)
+        id_filter = SharedIdFilter()
+        tweet_filter_api_crawler = TweetFilterAPICrawler(id_filter)
+        # one connection for all the batches, reopened only when keywords.txt changes or the stream drops
+        for ids in tweet_filter_api_crawler.stream(read_keywords, batch_number=100):
+            # marked as seen right before they are stored, see SharedIdFilter
+            ids = id_filter.filter_new(ids)
             # tweet_dumper.insert(ids, id_mode=True)
-            time.sleep(10)
+            pass
     elif mode == "search_mode":
-        tweet_search_api_crawler = TweetSearchAPICrawler()
+        id_filter = SharedIdFilter()
+        tweet_search_api_crawler = TweetSearchAPICrawler(id_filter)
         while True:
             keywords = read_keywords()
             ids = tweet_search_api_crawler.crawl(keywords, batch_number=100)
+            ids = id_filter.filter_new(ids)
             # tweet_dumper.insert(ids, id_mode=True)
     elif mode == "id_mode":
         tweet_id_mode_crawler = TweetIDModeCrawler()
         while True:
             try:
-                for ids in _fetch_id_from_db():
-                    status = tweet_id_mode_crawler.crawl(ids)
+                # one request in flight per credential, the api clients sleep on their own rate limits
+                for ids, status in tweet_id_mode_crawler.crawl_many(_fetch_id_from_db()):
                     logging.info(ids)
                     tweets = tweet_extractor.extract(status)
                     ids_with_text = {t['id'] for t in tweets}
@@ -68,7 +80,6 @@ def start(mode):
                     tweet_extractor.export(status, file_name="coronavirus")
                     # tweet_dumper.insert(tweets)
                     # tweet_dumper.delete(ids_no_text)
-                    time.sleep(5)
             except:
                 pass
             finally:
@@ -80,16 +91,28 @@ def start(mode):
         lock = Lock()
 
         # for mode in ['id_mode', 'search_mode', 'filter_mode']:
+        def export_new(id_filter: SharedIdFilter, tweets) -> None:
+            # ids are marked as seen only now, a crash before the export leaves them to be crawled again
+            new_ids = set(id_filter.filter_new([int(tweet['id']) for tweet in tweets]))
+            lock.acquire()
+            tweet_extractor.export([tweet for tweet in tweets if int(tweet['id']) in new_ids], file_name="coronavirus")
+            lock.release()
+
         def thread_function(partition):
             try:
-                tweets = list()
+                # opened in each process, all partitions share the same ids
+                id_filter = SharedIdFilter()
+                tweets = dict()
                 for tweet in TweetCOVID19APICrawler().crawl(partition):
-                    tweets.append(tweet)
+                    tweet_id = int(tweet['id'])
+                    if tweet_id in tweets or tweet_id in id_filter:
+                        continue
+                    tweets[tweet_id] = tweet
                     if len(tweets) == 100:
-                        lock.acquire()
-                        tweet_extractor.export(tweets, file_name="coronavirus")
-                        lock.release()
+                        export_new(id_filter, list(tweets.values()))
                         tweets.clear()
+                if tweets:
+                    export_new(id_filter, list(tweets.values()))
             except:
                 lock.acquire()
                 exit(1)
@@ -21,6 +21,17 @@ GENERAL_LOG_CONFIG_PATH = os.path.join(CONFIGS_DIR, 'general-logger.conf')
 CACHE_DIR = os.path.join(ROOT_DIR, 'cache')
 
 TWITTER_TEXT_CACHE = os.path.join(CACHE_DIR, 'twitter.cache.pickle')
+# dir for the tweet id filter shared by all crawler processes
+TWITTER_ID_FILTER_DIR = os.path.join(CACHE_DIR, 'id_filter')
+# dir for the batches the buffered dumper spills when its queue is full
+DUMPER_SPILL_DIR = os.path.join(CACHE_DIR, 'dumper_spill')
+
+# dir for geo tagging data
+GEO_TAG_DIR = os.path.join(ROOT_DIR, 'geo_tag')
+CITY_JSON_PATH = os.path.join(GEO_TAG_DIR, 'city.json')
+US_STATE_ABBREV_PATH = os.path.join(GEO_TAG_DIR, 'us_state_abbrev.json')
+# dir for the memory-mapped gazetteer built from city.json
+GAZETTEER_DIR = os.path.join(CACHE_DIR, 'gazetteer')
 
 # dir for data backup
 BACKUP_DIR = os.path.join(ROOT_DIR, 'backup')
@@ -1,20 +1,181 @@
-class CacheSet(set):
+from array import array
+from typing import Iterable, Iterator
+
+
+class CacheSet:
     """
-    A Simple Set that used for Cache, will have a memory limitation defined by MAX.
+    A Simple Set of int ids that used for Cache, will have a memory limitation defined by MAX.
+
+    if more than MAX elements are inserted, elements are evicted with regard of insertion order ('fifo'), or with
+    regard of the last time they were added or found ('lru', ids not seen within the last MAX insertions are evicted).
 
-    if more than MAX elements are inserted, elements are popped with regard of insertion order.
+    The ids are kept in an int64 ring buffer in insertion order, indexed by an open-addressing hash table of int32 ring
+    positions. Both start small and double as ids come in, up to what maximum_size needs, so a set costs 8 to 16 bytes
+    per id for the ring plus 7 to 14 for the table, instead of the ~80 bytes of a python set of ints.
     """
     MAX = 1e7
+    POLICIES = ('fifo', 'lru')
+    _EMPTY = -1
+    _LOAD_FACTOR = 0.6
+    _INITIAL_SIZE = 1024
+
+    def __init__(self, s: Iterable[int] = (), maximum_size=MAX, policy: str = 'fifo'):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown eviction policy {policy}, expecting one of {self.POLICIES}")
+        self.maximum_size = int(maximum_size)
+        if self.maximum_size <= 0:
+            raise ValueError("maximum_size must be positive")
+        self.policy = policy
+        self.clear()
+        self.update(s)
+
+    @classmethod
+    def _table_size(cls, maximum_size: int) -> int:
+        table_size = 1
+        while table_size * cls._LOAD_FACTOR < maximum_size:
+            table_size *= 2
+        return table_size
+
+    def clear(self) -> None:
+        initial_size = min(self.maximum_size, self._INITIAL_SIZE)
+        # ring of ids in insertion order, _head is the next position to write
+        self._ring = array('q', [0]) * initial_size
+        self._set_table(self._table_size(initial_size))
+        self._head = 0
+        self._filled = 0
+        self._size = 0
+
+    def _set_table(self, table_size: int) -> None:
+        self._bits = table_size.bit_length() - 1
+        self._mask = table_size - 1
+        # hash table of ring positions, _EMPTY for free slots
+        self._table = array('i', [self._EMPTY]) * table_size
+
+    def _grow_ring(self) -> None:
+        # until the ring is full it is written from 0 on without wrapping, so it is extended in place
+        ring_size = min(2 * len(self._ring), self.maximum_size)
+        self._ring.extend(array('q', [0]) * (ring_size - len(self._ring)))
+
+    def _grow_table(self) -> None:
+        """doubles the hash table, inserting the ring positions again"""
+        positions = [position for position in self._table if position != self._EMPTY]
+        self._set_table(2 * len(self._table))
+        table, ring, mask = self._table, self._ring, self._mask
+        for position in positions:
+            i = self._hash(ring[position])
+            while table[i] != self._EMPTY:
+                i = (i + 1) & mask
+            table[i] = position
+
+    def _hash(self, element: int) -> int:
+        # fibonacci hashing, spreads the sequential bits of snowflake ids over the table
+        return ((element * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - self._bits) if self._bits else 0
 
-    def __init__(self, s=(), maximum_size=MAX):
-        super(CacheSet, self).__init__(s)
-        self.maximum_size = maximum_size
+    def _find(self, element: int) -> int:
+        """returns the table slot of the element, or -1 if it is not in the set"""
+        table, ring, mask = self._table, self._ring, self._mask
+        i = self._hash(element)
+        while True:
+            position = table[i]
+            if position == self._EMPTY:
+                return -1
+            if ring[position] == element:
+                return i
+            i = (i + 1) & mask
 
-    def add(self, element):
-        if self.__len__() >= self.maximum_size:
-            self.pop()
-        set.add(self, element)
+    def _remove_slot(self, i: int) -> None:
+        """frees the table slot i, shifting back the following entries of the probe sequence"""
+        table, ring, mask = self._table, self._ring, self._mask
+        j = i
+        while True:
+            table[i] = self._EMPTY
+            while True:
+                j = (j + 1) & mask
+                if table[j] == self._EMPTY:
+                    self._size -= 1
+                    return
+                k = self._hash(ring[table[j]])
+                # the entry at j can stay if its home slot k lies cyclically in (i, j]
+                if (i < k <= j) if i <= j else (i < k or k <= j):
+                    continue
+                break
+            table[i] = table[j]
+            i = j
 
-    def update(self, elements):
+    def _evict_head(self) -> None:
+        """frees the ring position at _head, removing the id stored there if it is still indexed at that position"""
+        if self._filled < self.maximum_size:
+            if self._filled == len(self._ring):
+                self._grow_ring()
+            self._filled += 1
+            return
+        i = self._find(self._ring[self._head])
+        # with 'lru' the id may have moved to a newer position, leaving a stale one here
+        if i != -1 and self._table[i] == self._head:
+            self._remove_slot(i)
+
+    def _append(self, element: int) -> None:
+        self._evict_head()
+        if self._size + 1 > len(self._table) * self._LOAD_FACTOR:
+            self._grow_table()
+        self._ring[self._head] = element
+        i = self._hash(element)
+        while self._table[i] != self._EMPTY:
+            i = (i + 1) & self._mask
+        self._table[i] = self._head
+        self._head = (self._head + 1) % self.maximum_size
+        self._size += 1
+
+    def add(self, element: int) -> None:
+        i = self._find(element)
+        if i != -1:
+            if self.policy == 'lru':
+                self._remove_slot(i)
+                self._append(element)
+            return
+        self._append(element)
+
+    def update(self, elements: Iterable[int]) -> None:
         for ele in elements:
             self.add(ele)
+
+    def __contains__(self, element) -> bool:
+        if not isinstance(element, int):
+            return False
+        i = self._find(element)
+        if i != -1 and self.policy == 'lru':
+            # a hit counts as a use
+            self._remove_slot(i)
+            self._append(element)
+        return i != -1
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[int]:
+        """iterates the ids from the oldest to the newest"""
+        start = self._head if self._filled == self.maximum_size else 0
+        for offset in range(self._filled):
+            position = (start + offset) % self.maximum_size
+            element = self._ring[position]
+            i = self._find(element)
+            if i != -1 and self._table[i] == position:
+                yield element
+
+    def __setstate__(self, state):
+        if '_ring' in state:
+            self.__dict__.update(state)
+            return
+        # pickles of the former set based CacheSet are rebuilt from their elements by __init__, with the default size
+        elements = list(self)
+        self.maximum_size = int(state.get('maximum_size', self.MAX))
+        self.policy = state.get('policy', 'fifo')
+        self.clear()
+        self.update(elements)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(size={self._size}, maximum_size={self.maximum_size}, policy={self.policy})'
+
+    def __class_getitem__(cls, item):
+        # keeps annotations like CacheSet[int] working
+        return cls
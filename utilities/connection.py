@@ -1,9 +1,13 @@
+import hashlib
 import logging
 import threading
-from datetime import datetime
-from typing import Tuple, Any, List, Iterator
+import time
+import weakref
+from collections import namedtuple
+from typing import Tuple, Any, List, Iterator, Dict
 
 import psycopg2.pool
+from psycopg2 import extras
 import rootpath
 from deprecated import deprecated
 
@@ -24,43 +28,124 @@ def synchronized(func):
     return lock_func
 
 
+PoolStats = namedtuple('PoolStats', ['in_use', 'maxconn', 'checkouts', 'waits', 'wait_time'])
+
+
 class Connection:
-    _pool = None
-    _sem_remaining = None  # type: threading.Semaphore
+    # database.ini section of each role, the replica role falls back to the primary without its section
+    ROLES = {'primary': 'postgresql', 'replica': 'postgresql_replica'}
+    _pools = {}  # type: Dict[str, psycopg2.pool.ThreadedConnectionPool]
+    _sems_remaining = {}  # type: Dict[str, threading.Semaphore]
+    _config = None
+    # pooled connections the PostGIS types are registered on already
+    _registered = weakref.WeakSet()
+    # names of the statements prepared by sql_execute_values on each pooled connection
+    _prepared = weakref.WeakKeyDictionary()
+
+    # seconds between two connection status logs, 0 to disable, overridden by status_interval in database.ini
+    STATUS_INTERVAL = 300
+    _status_interval = STATUS_INTERVAL
+    _last_status = float('-inf')
+
+    _stats_lock = threading.Lock()
+    # in use, checkouts, waits, wait time of each role
+    _stats = {}  # type: Dict[str, List]
 
     @synchronized
-    def __init__(self):
+    def __init__(self, role: str = 'primary'):
+        if role not in self.ROLES:
+            raise ValueError(f"unknown role {role}, expecting one of {tuple(self.ROLES)}")
         self.conn = None
-        if not Connection._pool:
-            Connection._pool = psycopg2.pool.ThreadedConnectionPool(**self.config())
-            Connection._sem_remaining = threading.Semaphore(int(self.config().get('maxconn', 4)))
+        self.role = role if self.ROLES[role] in self._sections() else 'primary'
+        if self.role not in Connection._pools:
+            config = self.config(self.role)
+            config.pop('status_interval', None)
+            Connection._pools[self.role] = psycopg2.pool.ThreadedConnectionPool(**config)
+            Connection._sems_remaining[self.role] = threading.Semaphore(int(config.get('maxconn', 4)))
+            Connection._stats[self.role] = [0, 0, 0, 0.0]
 
     def __enter__(self, *args, **kwargs):
-        """Context Manager enter point, returns an available connection from the _pool"""
-        Connection._sem_remaining.acquire(blocking=True)
-        self.conn = Connection._pool.getconn(*args, **kwargs)
-        register(self.conn)
-        self.get_connection_status(self.conn)
+        """Context Manager enter point, returns an available connection from the pool of the role"""
+        stats = Connection._stats[self.role]
+        if not Connection._sems_remaining[self.role].acquire(blocking=False):
+            start = time.monotonic()
+            Connection._sems_remaining[self.role].acquire(blocking=True)
+            with Connection._stats_lock:
+                stats[2] += 1
+                stats[3] += time.monotonic() - start
+        self.conn = Connection._pools[self.role].getconn(*args, **kwargs)
+        with Connection._stats_lock:
+            stats[0] += 1
+            stats[1] += 1
+        if self.conn not in Connection._registered:
+            # the types stay registered for the lifetime of the physical connection
+            register(self.conn)
+            Connection._registered.add(self.conn)
+        self._maybe_log_status(self.conn)
         return self.conn
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        """Context Manager exit point, put the occupied connection back into the _pool"""
-        Connection._pool.putconn(self.conn)
-        Connection._sem_remaining.release()
+        """Context Manager exit point, put the occupied connection back into the pool of the role"""
+        Connection._pools[self.role].putconn(self.conn)
+        with Connection._stats_lock:
+            Connection._stats[self.role][0] -= 1
+        Connection._sems_remaining[self.role].release()
+
+    @staticmethod
+    def _maybe_log_status(connection) -> None:
+        """logs the connection status at most once every status interval"""
+        if not Connection._status_interval:
+            return
+        with Connection._stats_lock:
+            now = time.monotonic()
+            if now - Connection._last_status < Connection._status_interval:
+                return
+            Connection._last_status = now
+        Connection.get_connection_status(connection)
+
+    @staticmethod
+    def pool_stats(role: str = 'primary') -> PoolStats:
+        """returns the connections in use, the pool size, and the checkouts so far, how many of them waited for a
+        free connection and how long they waited in total (seconds), of the pool the role is routed to"""
+        if role != 'primary' and Connection.ROLES[role] not in Connection._sections():
+            role = 'primary'
+        if role not in Connection._stats:
+            return PoolStats(0, 0, 0, 0, 0.0)
+        maxconn = int(Connection.config(role).get('maxconn', 4))
+        with Connection._stats_lock:
+            return PoolStats(Connection._stats[role][0], maxconn, *Connection._stats[role][1:])
 
     @staticmethod
     @deprecated(reason="__call__ will no longer be provided in future, please always use context manager (with)")
     def __call__(*args, **kwargs):
         """returns a newly created connection, which is not maintained by the _pool"""
-        connection = psycopg2.connect(*args, **parse(DATABASE_CONFIG_PATH, 'postgresql',
-                                                     unwanted_fields=["minconn", "maxconn"]), **kwargs)
+        config = Connection.config()
+        for field in ("minconn", "maxconn", "status_interval"):
+            config.pop(field, None)
+        connection = psycopg2.connect(*args, **config, **kwargs)
         register(connection)
         Connection.get_connection_status(connection)
         return connection
 
     @staticmethod
-    def config():
-        return parse(DATABASE_CONFIG_PATH, 'postgresql')
+    def _sections(reload: bool = False) -> dict:
+        """returns all the sections of database.ini, parsed once"""
+        if Connection._config is None or reload:
+            Connection._config = parse(DATABASE_CONFIG_PATH)
+            Connection._status_interval = float(Connection._config.get(Connection.ROLES['primary'], {})
+                                                .get('status_interval') or Connection.STATUS_INTERVAL)
+        return Connection._config
+
+    @staticmethod
+    def config(role: str = 'primary', reload: bool = False) -> dict:
+        """returns a copy of the database.ini section of the role, the primary one if the role has none"""
+        sections = Connection._sections(reload)
+        section = Connection.ROLES[role]
+        if section not in sections:
+            section = Connection.ROLES['primary']
+        if section not in sections:
+            raise KeyError(f'Section {section} not found in the {DATABASE_CONFIG_PATH} file')
+        return dict(sections[section])
 
     @staticmethod
     def get_connection_status(connection):
@@ -71,25 +156,55 @@ class Connection:
         connection_max_count, = cursor.fetchone()
         # adding this log to show current database connection status
         logger.info(
-            f"[DATABASE] HOST = {Connection.config().get('host')}, CONNECTION COUNT "
+            f"[DATABASE] HOST = {connection.get_dsn_parameters().get('host')}, CONNECTION COUNT "
             f"= {connection_count}, MAXIMUM = {connection_max_count}")
         cursor.close()
 
     @staticmethod
-    def sql_execute(sql: str) -> Iterator:
-        """to execute an SQL query and fetch all results"""
+    def sql_execute(sql: str, role: str = 'replica') -> Iterator:
+        """to execute an SQL query and fetch all results, on a replica if database.ini has one"""
         logger.info(f"SQL: {sql}")
         if any([keyword in sql.upper() for keyword in ["INSERT", "UPDATE"]]):
             logger.error("You are running INSERT or UPDATE without committing, transaction aborted. Please retry with "
                          "sql_execute_commit")
             return iter([])
-        with Connection() as connection:
+        with Connection(role) as connection:
             cursor = connection.cursor()
             cursor.execute(sql)
             rows = cursor.fetchall()
             cursor.close()
             return iter(rows)
 
+    @staticmethod
+    def sql_stream(sql: str, itersize: int = 2000, chunk_size: int = None, role: str = 'replica') -> Iterator:
+        """to execute an SQL query and stream the results through a server-side cursor
+
+        rows are fetched itersize at a time, and yielded one by one, or as lists of chunk_size rows if given. the
+        connection, of a replica if database.ini has one, is held until the iteration ends or the generator is closed.
+        """
+        logger.info(f"SQL (streaming): {sql}")
+        if any([keyword in sql.upper() for keyword in ["INSERT", "UPDATE"]]):
+            logger.error("You are running INSERT or UPDATE without committing, transaction aborted. Please retry with "
+                         "sql_execute_commit")
+            return
+        with Connection(role) as connection:
+            # a named cursor lives on the server, inside the transaction it opens
+            cursor = connection.cursor(name=f"stream_{threading.get_ident()}_{time.monotonic_ns()}")
+            cursor.itersize = itersize
+            try:
+                cursor.execute(sql)
+                if chunk_size:
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield rows
+                else:
+                    yield from cursor
+            finally:
+                cursor.close()
+                connection.rollback()
+
     @staticmethod
     def sql_execute_commit(sql: object) -> None:
         """to execute and commit an SQL query"""
@@ -102,16 +217,57 @@ class Connection:
             cursor.close()
 
     @staticmethod
-    def sql_execute_values(sql: str, value_tuples: List[Tuple[Any]], ignore_duplicate: bool = True) -> None:
-        """to execute and commit an SQL query with multiple value tuples"""
-        value_tuples_sql = ", ".join(
-            [f"({', '.join([repr(str(entry)) if isinstance(entry, datetime) else repr(entry) for entry in entries])})"
-             for entries in value_tuples])
-        if value_tuples_sql:
-            sql += " " + value_tuples_sql + f" ON CONFLICT DO NOTHING" if ignore_duplicate else ""
-            Connection.sql_execute_commit(sql)
-        else:
+    def _prepare(connection, cursor, sql: str, row_count: int, width: int) -> str:
+        """prepares sql with row_count tuples of width parameters on the connection once, returns the statement name"""
+        name = 'values_' + hashlib.md5(f'{sql}|{row_count}|{width}'.encode()).hexdigest()[:16]
+        prepared = Connection._prepared.setdefault(connection, set())
+        if name not in prepared:
+            cursor.execute("SELECT 1 FROM pg_prepared_statements WHERE name = %s", (name,))
+            if cursor.fetchone() is None:
+                placeholders = ', '.join('(' + ', '.join(f'${row * width + column + 1}' for column in range(width)) + ')'
+                                         for row in range(row_count))
+                cursor.execute(f"PREPARE {name} AS {sql.replace('%s', placeholders, 1)}")
+            prepared.add(name)
+        return name
+
+    @staticmethod
+    def sql_execute_values(sql: str, value_tuples: List[Tuple[Any]], ignore_duplicate: bool = True,
+                           page_size: int = 1000, prepare: bool = True) -> int:
+        """to execute and commit an SQL query with multiple value tuples, returns the number of affected rows
+
+        sql is the statement up to VALUES, e.g. "INSERT INTO t (a, b) VALUES". the values are bound as parameters,
+        page_size tuples per statement. with prepare, full pages run a statement prepared once per connection and
+        shape, the last partial page goes through execute_values.
+        """
+        value_tuples = list(value_tuples)
+        if not value_tuples:
             logger.info("[DATABASE] Nothing to commit")
+            return 0
+        sql = f"{sql} %s" + (" ON CONFLICT DO NOTHING" if ignore_duplicate else "")
+        logger.info(f"SQL: {sql}, {len(value_tuples)} value tuples")
+        width = len(value_tuples[0])
+        affected_count = 0
+        with Connection() as connection:
+            cursor = connection.cursor()
+            try:
+                for start in range(0, len(value_tuples), page_size):
+                    page = value_tuples[start:start + page_size]
+                    if prepare and len(page) == page_size:
+                        name = Connection._prepare(connection, cursor, sql, page_size, width)
+                        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * width * page_size)})",
+                                       [entry for entries in page for entry in entries])
+                    else:
+                        extras.execute_values(cursor, sql, page, page_size=len(page))
+                    affected_count += cursor.rowcount
+            except Exception:
+                # statements prepared in the aborted transaction are checked again on the next use
+                Connection._prepared.pop(connection, None)
+                connection.rollback()
+                raise
+            connection.commit()
+            logger.info(f"Affected rows:{affected_count}")
+            cursor.close()
+        return affected_count
 
 
 if __name__ == '__main__':
@@ -135,6 +291,10 @@ if __name__ == '__main__':
     for row in Connection.sql_execute("select * from pg_tables"):
         print(row)
 
+    # stream the output through a server-side cursor, 100 rows at a time
+    for rows in Connection.sql_stream("select * from pg_tables", chunk_size=100):
+        print(len(rows))
+
     # remains supported for now.
     for row in Connection().sql_execute("select * from pg_tables"):
         print(row)
@@ -0,0 +1,230 @@
+import fcntl
+import logging
+import math
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterable, List
+
+import rootpath
+
+rootpath.append()
+
+from paths import TWITTER_ID_FILTER_DIR
+from utilities.cacheset import CacheSet
+
+logger = logging.getLogger()
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+_HEADER_BYTES = 64
+_VERSION = 1
+
+
+def _mix(x: int) -> int:
+    """splitmix64 finalizer"""
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def _create_file(path: str, header: List[int], body_size: int, fill: bytes = b'\x00') -> None:
+    """writes a new mapped file: int64 header then body_size bytes of fill, renamed into place once complete"""
+    temp_path = f'{path}.{os.getpid()}'
+    with open(temp_path, 'wb') as file:
+        file.write(b''.join(value.to_bytes(8, 'little', signed=True) for value in header).ljust(_HEADER_BYTES, b'\0'))
+        if fill == b'\x00':
+            file.truncate(_HEADER_BYTES + body_size)
+        else:
+            chunk = fill * (1 << 20)
+            for offset in range(0, body_size, len(chunk)):
+                file.write(chunk[:body_size - offset])
+    os.replace(temp_path, path)
+
+
+def _map_file(path: str) -> mmap.mmap:
+    with open(path, 'r+b') as file:
+        return mmap.mmap(file.fileno(), 0)
+
+
+class MappedCacheSet(CacheSet):
+    """
+    A fifo CacheSet whose ring buffer, hash table and counters live in a memory-mapped file, so that every process
+    mapping the same file sees the same set. Callers have to serialize writers themselves.
+    """
+
+    def __init__(self, path: str, maximum_size=CacheSet.MAX):
+        if not os.path.exists(path):
+            maximum_size = int(maximum_size)
+            _create_file(path, [_VERSION, maximum_size, 0, 0, 0],
+                         8 * maximum_size + 4 * self._table_size(maximum_size), fill=b'\xff')
+        self._mmap = _map_file(path)
+        self._header = memoryview(self._mmap)[:_HEADER_BYTES].cast('q')
+        if self._header[0] != _VERSION:
+            raise ValueError(f"unknown id window version in {path}")
+        # the file decides the size, an existing window keeps the size it was created with
+        self.maximum_size = self._header[1]
+        self.policy = 'fifo'
+        table_size = self._table_size(self.maximum_size)
+        self._bits = table_size.bit_length() - 1
+        self._mask = table_size - 1
+        ring_end = _HEADER_BYTES + 8 * self.maximum_size
+        self._ring = memoryview(self._mmap)[_HEADER_BYTES:ring_end].cast('q')
+        self._table = memoryview(self._mmap)[ring_end:ring_end + 4 * table_size].cast('i')
+
+    # the counters are read from and written to the shared header
+    _head = property(lambda self: self._header[2], lambda self, value: self._header.__setitem__(2, value))
+    _filled = property(lambda self: self._header[3], lambda self, value: self._header.__setitem__(3, value))
+    _size = property(lambda self: self._header[4], lambda self, value: self._header.__setitem__(4, value))
+
+    def clear(self) -> None:
+        self._table[:] = memoryview(b'\xff' * (4 * len(self._table))).cast('i')
+        self._head = self._filled = self._size = 0
+
+    def flush(self) -> None:
+        self._mmap.flush()
+
+    def close(self) -> None:
+        for view in (self._ring, self._table, self._header):
+            view.release()
+        self._mmap.close()
+
+
+class MappedBloomFilter:
+    """A bloom filter of int ids in a memory-mapped file, sized for capacity ids at the given false positive rate"""
+
+    def __init__(self, path: str, capacity=5e7, error_rate=1e-4):
+        if not os.path.exists(path):
+            num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2 / 8)) * 8
+            num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+            _create_file(path, [_VERSION, num_bits, num_hashes, 0, int(capacity)], num_bits // 8)
+        self._mmap = _map_file(path)
+        self._header = memoryview(self._mmap)[:_HEADER_BYTES].cast('q')
+        if self._header[0] != _VERSION:
+            raise ValueError(f"unknown bloom filter version in {path}")
+        _, self.num_bits, self.num_hashes, _, self.capacity = self._header[:5]
+        self._bits = memoryview(self._mmap)[_HEADER_BYTES:]
+
+    @property
+    def count(self) -> int:
+        """number of ids added so far, the false positive rate grows past capacity"""
+        return self._header[3]
+
+    def _positions(self, element: int) -> Iterable[int]:
+        # double hashing, k positions out of two 64 bits hashes
+        h1 = _mix(element & _MASK64)
+        h2 = _mix(h1) | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def __contains__(self, element: int) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(element))
+
+    def add(self, element: int) -> bool:
+        """sets the bits of the element, returns whether they were all set already"""
+        bits = self._bits
+        present = True
+        for position in self._positions(element):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                present = False
+        if not present:
+            self._header[3] += 1
+            if self._header[3] == self.capacity:
+                logger.warning(f"id bloom filter reached its capacity {self.capacity}, false positives will grow")
+        return present
+
+    def flush(self) -> None:
+        self._mmap.flush()
+
+    def close(self) -> None:
+        for view in (self._bits, self._header):
+            view.release()
+        self._mmap.close()
+
+
+class SharedIdFilter:
+    """
+    Tweet id dedup filter shared by all the crawler processes of a host, persisted across restarts.
+
+    An exact window of the most recent ids (a MappedCacheSet) is checked first, then a bloom filter remembers all
+    the ids ever added. An id is new only if neither has seen it, so about error_rate of the new ids are dropped
+    as false positives once they fall out of the window. Both live in memory-mapped files under directory, writes
+    are serialized with a flock on a lock file in the same directory.
+
+    Since the filter outlives the process, ids should only be marked once they are persisted. Crawlers check them
+    with unseen, and the caller marks them with filter_new right before writing them out, so that a crash in between
+    does not skip them forever.
+    """
+    WINDOW_SIZE = 1e6
+
+    def __init__(self, directory: str = TWITTER_ID_FILTER_DIR, capacity=5e7, error_rate=1e-4,
+                 window_size=WINDOW_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._lock_path = os.path.join(directory, 'lock')
+        self._thread_lock = threading.Lock()
+        self._lock_file = None
+        self._lock_pid = None
+        with self._locked():
+            self.window = MappedCacheSet(os.path.join(directory, 'window'), window_size)
+            self.bloom = MappedBloomFilter(os.path.join(directory, 'bloom'), capacity, error_rate)
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            # flock is held per open file, forked processes need their own
+            if self._lock_pid != os.getpid():
+                self._lock_file = open(self._lock_path, 'a+')
+                self._lock_pid = os.getpid()
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _add(self, tweet_id: int) -> bool:
+        if tweet_id in self.window:
+            return False
+        self.window.add(tweet_id)
+        return not self.bloom.add(tweet_id)
+
+    def add(self, tweet_id: int) -> bool:
+        """marks the id as seen, returns whether it is new to all processes"""
+        with self._locked():
+            return self._add(tweet_id)
+
+    def filter_new(self, ids: Iterable[int]) -> List[int]:
+        """marks all ids as seen, returns the ones that are new to all processes, in order"""
+        with self._locked():
+            return [tweet_id for tweet_id in ids if self._add(tweet_id)]
+
+    def unseen(self, ids: Iterable[int]) -> List[int]:
+        """returns the ids no process has marked as seen yet, in order, without marking them"""
+        with self._locked():
+            return [tweet_id for tweet_id in ids if tweet_id not in self.window and tweet_id not in self.bloom]
+
+    def __contains__(self, tweet_id: int) -> bool:
+        with self._locked():
+            return tweet_id in self.window or tweet_id in self.bloom
+
+    def flush(self) -> None:
+        """writes the mapped pages back to disk, the OS does it eventually anyway"""
+        self.window.flush()
+        self.bloom.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self.window.close()
+        self.bloom.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+
+if __name__ == '__main__':
+    id_filter = SharedIdFilter()
+    print(id_filter.filter_new([1, 2, 3, 2]))
+    print(id_filter.filter_new([3, 4]))
+    id_filter.close()
@@ -0,0 +1,80 @@
+import logging
+import os
+import pickle
+from array import array
+from typing import Iterable, Optional
+
+import rootpath
+
+rootpath.append()
+
+from utilities.cacheset import CacheSet
+
+logger = logging.getLogger()
+
+
+class IdLog:
+    """
+    Persists a CacheSet of ids as a pickled snapshot plus an append-only log of the ids added since.
+
+    load() restores the snapshot and replays the log, append() only writes the new ids, and every compact_every
+    logged ids the whole set is written as the new snapshot and the log starts over.
+    """
+    COMPACT_EVERY = 1e6
+
+    def __init__(self, snapshot_path: str, compact_every=COMPACT_EVERY, maximum_size=CacheSet.MAX):
+        self.snapshot_path = snapshot_path
+        self.log_path = f'{snapshot_path}.log'
+        self.compact_every = int(compact_every)
+        self.maximum_size = maximum_size
+        self.cache: Optional[CacheSet] = None
+        self._logged_count = 0
+
+    def load(self) -> CacheSet:
+        """returns the cache from the snapshot and the log, an empty one if neither exists"""
+        try:
+            with open(self.snapshot_path, 'rb') as snapshot_file:
+                self.cache = pickle.load(snapshot_file)
+            logger.info(f"loaded {len(self.cache)} ids from {self.snapshot_path}")
+        except FileNotFoundError:
+            self.cache = CacheSet(maximum_size=self.maximum_size)
+        except (pickle.UnpicklingError, EOFError) as err:
+            logger.error(f"can not load {self.snapshot_path}, starting from the log only: {err}")
+            self.cache = CacheSet(maximum_size=self.maximum_size)
+
+        logged = array('q')
+        try:
+            with open(self.log_path, 'rb') as log_file:
+                data = log_file.read()
+            # a crash may leave a partial record at the end
+            logged.frombytes(data[:len(data) - len(data) % logged.itemsize])
+        except FileNotFoundError:
+            pass
+        self.cache.update(logged)
+        self._logged_count = len(logged)
+        logger.info(f"replayed {len(logged)} ids from {self.log_path}")
+        return self.cache
+
+    def append(self, ids: Iterable[int]) -> None:
+        """logs ids that were just added to the cache, compacting once enough ids are logged"""
+        if self.cache is None:
+            raise ValueError("IdLog.load must be called before IdLog.append")
+        records = array('q', ids)
+        if not records:
+            return
+        with open(self.log_path, 'ab') as log_file:
+            log_file.write(records.tobytes())
+        self._logged_count += len(records)
+        if self._logged_count >= self.compact_every:
+            self.compact()
+
+    def compact(self) -> None:
+        """writes the whole cache as the new snapshot, then empties the log"""
+        temp_path = f'{self.snapshot_path}.{os.getpid()}'
+        with open(temp_path, 'wb') as snapshot_file:
+            pickle.dump(self.cache, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.snapshot_path)
+        # the ids of the log are all in the snapshot now, a crash before this line only replays them again
+        open(self.log_path, 'wb').close()
+        self._logged_count = 0
+        logger.info(f"compacted {len(self.cache)} ids into {self.snapshot_path}")
@@ -0,0 +1,80 @@
+from collections import deque
+from typing import Iterable, Set, List, Dict, Tuple
+
+
+class KeywordMatcher:
+    """
+    Aho–Corasick automaton of a keyword set, finds which keywords occur in a text in a single pass over it.
+
+    Matching is on plain substrings, like `keyword in text`, so texts and keywords have to be lower cased by the
+    caller if needed.
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords = frozenset(keywords)
+        # state 0 is the root, _goto[state] maps the next character to a state
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # keywords ending at each state, including the ones of its fail states
+        self._out: List[Tuple[str, ...]] = [()]
+        for keyword in self.keywords:
+            self._add(keyword)
+        self._link()
+
+    def _add(self, keyword: str) -> None:
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = next_state
+        self._out[state] += (keyword,)
+
+    def _link(self) -> None:
+        """sets the fail state of every state, breadth first, merging the outputs along the way"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] += self._out[self._fail[next_state]]
+                queue.append(next_state)
+
+    def _states(self, text: str) -> Iterable[int]:
+        goto, fail = self._goto, self._fail
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            yield state
+
+    def search(self, text: str) -> bool:
+        """returns whether any keyword occurs in the text, stopping at the first one found"""
+        out = self._out
+        if out[0]:
+            # the empty keyword matches everything
+            return True
+        return any(out[state] for state in self._states(text))
+
+    def matches(self, text: str) -> Set[str]:
+        """returns the keywords that occur in the text"""
+        out = self._out
+        found = set(out[0])
+        for state in self._states(text):
+            if out[state]:
+                found.update(out[state])
+        return found
+
+    def __contains__(self, text: str) -> bool:
+        return self.search(text)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(keywords={len(self.keywords)}, states={len(self._goto)})'
@@ -1,27 +1,232 @@
+import logging
+import os
 import threading
-from threading import Lock
+import time
+from threading import RLock
+from typing import Dict, Tuple, Optional, Set, List
 
 import twitter
 
 from paths import TWITTER_API_CONFIG_PATH
 from utilities.ini_parser import parse
 
+logger = logging.getLogger()
+
+
+class TokenBucket:
+    """
+    The request budget of one credential on one endpoint.
+
+    Twitter hands out `limit` requests per fixed window, the bucket is refilled to capacity once the window resets.
+    Requests are taken from it before they are sent, and it is synced with the x-rate-limit headers afterwards.
+    """
+    WINDOW = 15 * 60
+
+    def __init__(self, capacity: int = 15):
+        self.capacity = capacity
+        self.tokens = capacity
+        self.reset_at = 0.0
+
+    def available(self, now: float) -> int:
+        return self.capacity if now >= self.reset_at else self.tokens
+
+    def take(self, now: float) -> None:
+        if now >= self.reset_at:
+            # a new window starts with this request
+            self.tokens = self.capacity
+            self.reset_at = now + self.WINDOW
+        self.tokens -= 1
+
+    def wait_time(self, now: float) -> float:
+        """seconds until the bucket has a token"""
+        return 0 if self.available(now) > 0 else self.reset_at - now
+
+    def update(self, limit: int, remaining: int, reset: float) -> None:
+        # streaming endpoints send no rate limit headers, python-twitter records them as 0
+        if limit:
+            self.capacity = limit
+            self.tokens = remaining
+            self.reset_at = reset
+
 
 class TwitterAPILoadBalancer:
+    """
+    Hands out the twitter.Api of the credentials in twitter.ini.
+
+    The apis are built on first use, and rebuilt whenever twitter.ini changes on disk (checked at most every
+    RELOAD_INTERVAL seconds) or reload() is called, credentials whose section did not change keep their api and budget.
+
+    get() without an endpoint rotates through them. With an endpoint (a rate limit resource like '/statuses/lookup'),
+    get() and acquire() pick the credential with the most budget left on that endpoint, tracked with one TokenBucket
+    per credential and endpoint. The apis still sleep on rate limits by themselves, which only happens if the
+    budget here is off, callers that want to wait on their own use wait_time().
+    """
+    RELOAD_INTERVAL = 60
     iter_index = 0
-    apis = [twitter.Api(**config, sleep_on_rate_limit=True) for config in
-            parse(TWITTER_API_CONFIG_PATH).values() if config.get('access_token_key')]
-    lock = Lock()
+    # access_token_key -> api, in the order of twitter.ini
+    credentials: Dict[str, twitter.Api] = {}
+    # access_token_key -> the twitter.ini section its api was built from
+    _configs: Dict[str, Dict[str, str]] = {}
+    _loaded = False
+    _loaded_mtime = None
+    _checked_at = float('-inf')
+    lock = RLock()
+    # notified whenever a credential is released or the credentials are reloaded
+    available = threading.Condition(lock)
+    buckets: Dict[Tuple[str, str], TokenBucket] = {}
+    busy: Set[str] = set()
 
     @staticmethod
-    def get():
-        TwitterAPILoadBalancer.lock.acquire()
-        TwitterAPILoadBalancer.iter_index += 1
-        if TwitterAPILoadBalancer.iter_index == len(TwitterAPILoadBalancer.apis):
-            TwitterAPILoadBalancer.iter_index = 0
-        api = TwitterAPILoadBalancer.apis[TwitterAPILoadBalancer.iter_index]
-        TwitterAPILoadBalancer.lock.release()
-        return api
+    def get_apis() -> List[twitter.Api]:
+        """returns the apis of the current credentials, loading them on first use"""
+        with TwitterAPILoadBalancer.lock:
+            TwitterAPILoadBalancer._maybe_reload()
+            return list(TwitterAPILoadBalancer.credentials.values())
+
+    @staticmethod
+    def reload() -> None:
+        """reads twitter.ini again, building apis for the new credentials and dropping the removed ones"""
+        with TwitterAPILoadBalancer.lock:
+            try:
+                TwitterAPILoadBalancer._loaded_mtime = os.stat(TWITTER_API_CONFIG_PATH).st_mtime_ns
+            except FileNotFoundError:
+                TwitterAPILoadBalancer._loaded_mtime = None
+            configs = {config['access_token_key']: config for config in parse(TWITTER_API_CONFIG_PATH).values()
+                       if config.get('access_token_key')}
+            current, current_configs = TwitterAPILoadBalancer.credentials, TwitterAPILoadBalancer._configs
+            # a credential whose consumer key or secrets were rotated gets a new api and budget, like a new one
+            kept = {key for key, config in configs.items() if current_configs.get(key) == config}
+            TwitterAPILoadBalancer.credentials = {
+                key: current[key] if key in kept else twitter.Api(**config, sleep_on_rate_limit=True)
+                for key, config in configs.items()}
+            TwitterAPILoadBalancer._configs = configs
+            for bucket_key in [bucket_key for bucket_key in TwitterAPILoadBalancer.buckets
+                               if bucket_key[0] not in kept]:
+                del TwitterAPILoadBalancer.buckets[bucket_key]
+            TwitterAPILoadBalancer.busy.intersection_update(kept)
+            TwitterAPILoadBalancer._loaded = True
+            logger.info(f"loaded {len(configs)} twitter credentials, {len(configs.keys() - current.keys())} new, "
+                        f"{len((current.keys() & configs.keys()) - kept)} changed, "
+                        f"{len(current.keys() - configs.keys())} removed")
+            TwitterAPILoadBalancer.available.notify_all()
+
+    @staticmethod
+    def _maybe_reload() -> None:
+        now = time.monotonic()
+        if TwitterAPILoadBalancer._loaded and TwitterAPILoadBalancer._checked_at + \
+                TwitterAPILoadBalancer.RELOAD_INTERVAL > now:
+            return
+        TwitterAPILoadBalancer._checked_at = now
+        try:
+            mtime = os.stat(TWITTER_API_CONFIG_PATH).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != TwitterAPILoadBalancer._loaded_mtime or not TwitterAPILoadBalancer._loaded:
+            TwitterAPILoadBalancer.reload()
+
+    @staticmethod
+    def get(endpoint: Optional[str] = None) -> twitter.Api:
+        """returns the next api, or the one with the most budget left on the endpoint"""
+        with TwitterAPILoadBalancer.lock:
+            TwitterAPILoadBalancer._maybe_reload()
+            keys = list(TwitterAPILoadBalancer.credentials)
+            if endpoint is not None:
+                key, wait = TwitterAPILoadBalancer._pick(endpoint, exclusive=False)
+                if key is not None:
+                    TwitterAPILoadBalancer._bucket(key, endpoint).take(time.time())
+                    return TwitterAPILoadBalancer.credentials[key]
+                logger.warning(f"all credentials are out of budget on {endpoint} for {wait:.0f}s")
+            TwitterAPILoadBalancer.iter_index += 1
+            if TwitterAPILoadBalancer.iter_index >= len(keys):
+                TwitterAPILoadBalancer.iter_index = 0
+            return TwitterAPILoadBalancer.credentials[keys[TwitterAPILoadBalancer.iter_index]]
+
+    @staticmethod
+    def acquire(endpoint: str, exclusive: bool = False, timeout: Optional[float] = None) -> Optional[twitter.Api]:
+        """
+        Takes one request of budget on the endpoint from the credential with the most left.
+
+        Blocks until a credential has budget, or for at most timeout seconds, then returns None. With exclusive the
+        credential is not handed out again until it is released, every acquire has to be followed by a release,
+        which also syncs the budget with the rate limit the api just received.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with TwitterAPILoadBalancer.available:
+            while True:
+                TwitterAPILoadBalancer._maybe_reload()
+                key, wait = TwitterAPILoadBalancer._pick(endpoint, exclusive)
+                if key is not None:
+                    TwitterAPILoadBalancer._bucket(key, endpoint).take(time.time())
+                    if exclusive:
+                        TwitterAPILoadBalancer.busy.add(key)
+                    return TwitterAPILoadBalancer.credentials[key]
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                if wait is not None:
+                    logger.info(f"all credentials are out of budget on {endpoint}, waiting {wait:.0f}s")
+                # wakes up for reloads too, credentials may have been added
+                TwitterAPILoadBalancer.available.wait(min(wait, TwitterAPILoadBalancer.RELOAD_INTERVAL)
+                                                      if wait is not None else TwitterAPILoadBalancer.RELOAD_INTERVAL)
+
+    @staticmethod
+    def release(api: twitter.Api, endpoint: str) -> None:
+        """hands a credential back after its request, syncing its budget with the rate limit it received"""
+        with TwitterAPILoadBalancer.available:
+            key = next((key for key, credential_api in TwitterAPILoadBalancer.credentials.items()
+                        if credential_api is api), None)
+            if key is None:
+                # removed by a reload meanwhile
+                return
+            rate_limit = getattr(api, 'rate_limit', None)
+            if rate_limit is not None:
+                limit = rate_limit.get_limit(endpoint)
+                TwitterAPILoadBalancer._bucket(key, endpoint).update(limit.limit, limit.remaining, limit.reset)
+            TwitterAPILoadBalancer.busy.discard(key)
+            TwitterAPILoadBalancer.available.notify_all()
+
+    @staticmethod
+    def wait_time(endpoint: str) -> float:
+        """seconds until a credential has budget on the endpoint, 0 if one has some now"""
+        now = time.time()
+        with TwitterAPILoadBalancer.lock:
+            TwitterAPILoadBalancer._maybe_reload()
+            return min((TwitterAPILoadBalancer._bucket(key, endpoint).wait_time(now)
+                        for key in TwitterAPILoadBalancer.credentials), default=0)
+
+    @staticmethod
+    def _bucket(key: str, endpoint: str) -> TokenBucket:
+        bucket = TwitterAPILoadBalancer.buckets.get((key, endpoint))
+        if bucket is None:
+            bucket = TwitterAPILoadBalancer.buckets[(key, endpoint)] = TokenBucket()
+            rate_limit = getattr(TwitterAPILoadBalancer.credentials[key], 'rate_limit', None)
+            if rate_limit is not None:
+                limit = rate_limit.get_limit(endpoint)
+                bucket.update(limit.limit, limit.remaining, limit.reset)
+        return bucket
+
+    @staticmethod
+    def _pick(endpoint: str, exclusive: bool) -> Tuple[Optional[str], Optional[float]]:
+        """returns the key of the free credential with the most budget, or None and the seconds until one of
+        them has budget again (None if they are all busy)"""
+        now = time.time()
+        best, best_available, wait = None, 0, None
+        keys = list(TwitterAPILoadBalancer.credentials)
+        # ties go round robin
+        TwitterAPILoadBalancer.iter_index = (TwitterAPILoadBalancer.iter_index + 1) % max(len(keys), 1)
+        for offset in range(len(keys)):
+            key = keys[(TwitterAPILoadBalancer.iter_index + offset) % len(keys)]
+            if exclusive and key in TwitterAPILoadBalancer.busy:
+                continue
+            bucket = TwitterAPILoadBalancer._bucket(key, endpoint)
+            available = bucket.available(now)
+            if available > best_available:
+                best, best_available = key, available
+            elif available <= 0:
+                wait = bucket.wait_time(now) if wait is None else min(wait, bucket.wait_time(now))
+        return best, (None if best is not None else wait)
 
 
 if __name__ == '__main__':
@@ -36,3 +241,7 @@ if __name__ == '__main__':
         t.start()
     for t in threads:
         t.join()
+
+    api = TwitterAPILoadBalancer.acquire('/statuses/lookup', exclusive=True)
+    TwitterAPILoadBalancer.release(api, '/statuses/lookup')
+    print(TwitterAPILoadBalancer.wait_time('/statuses/lookup'))